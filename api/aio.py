@@ -0,0 +1,417 @@
+import asyncio
+import time
+import os
+import collections
+
+from api import log
+from api import frame
+from api import codec
+from api import registry
+
+REGISTER_DELAY = 1
+REQUEST_TIMEOUT = 5
+
+# asyncio counterpart of api.APIThread. Speaks the same length-prefixed
+# -JSON-/XML protocol, but all devices share one event loop instead of
+# owning a thread each.
+class AsyncAPIClient(object):
+    def __init__(self, host=None, port=None, key=None, name=None, timeout=3, onConnect=None, debug=False, apiPath=None, maxFrame=frame.MAX_FRAME_SIZE):
+        self.log = log.LogThread()
+        self.unix_sockets = ['/tmp/sh.socket', '/home/sh2/sh.sock']
+        self.connected = False
+        self.reader = None
+        self.writer = None
+        self.host = host
+        self.port = port if port else 2040
+        self.key = key
+        self.name = name
+        self.dbg = debug
+        self.timeout = timeout
+        self.connect_cb = [onConnect] if onConnect else []
+        self.addrs = {}
+        self.addrkeys = {}
+        self.devs = registry.DeviceRegistry()
+        self.tregdevs = 0
+        self.regTimer = None
+        self.subs = []
+        self.subsDevs = {}
+        self.subsTimer = None
+        self.listeners = []
+        self.xml = None
+        self.decoder = frame.FrameDecoder(maxFrame)
+        self.rxFrames = collections.deque()
+        self.abort = False
+        self.tasks = set()
+        self.pending = {} # response type -> deque of (deadline, future or None)
+        self.pendingDeadline = float('inf')
+        self.futureTypes = set()
+        self.dropped = 0 # messages dropped on full events() queues
+
+        if apiPath:
+            if apiPath[0]=='/': # UnixSocket
+                self.host = apiPath
+            else:
+                tmp = apiPath.split(':')
+                self.host = tmp[0]
+                if len(tmp)>1:
+                    self.port = int(tmp[1])
+                if len(tmp)>2:
+                    self.key = tmp[2]
+
+    def debug(self, d):
+        self.dbg = d
+
+    async def send(self, js):
+        d = b'-JSON-' + codec.dumps(js)
+        if self.dbg:
+            self.log.log("API sending: {}".format(d))
+        try:
+            self.writer.write(frame.encode(d))
+            await self.writer.drain()
+        except Exception as err:
+            self.log.log("Error sending data to socket: {}".format(err), 'RED')
+            self.reconnect()
+            return False
+        return True
+
+    async def request(self, type, param=None, auth=0, timeout=REQUEST_TIMEOUT):
+        if type not in self.futureTypes:
+            return await self._request(type, param, auth)
+        # keeps the FIFO order of types also requested with requestAsync()
+        entry = self._enqueue(type, None, timeout)
+        ret = await self._request(type, param, auth)
+        if not ret:
+            self._dequeue(type, entry)
+        return ret
+
+    async def _request(self, type, param, auth):
+        if not self.writer or (not auth and not self.connected):
+            self.log.log(f"Request error. API not connected: {type}", "RED")
+            return False
+        q = {'request':type}
+        if param:
+            q.update(param)
+        if self.dbg:
+            self.log.log("Request: {}".format(q))
+        return await self.send(q)
+
+    # Sends a request and returns its response, as APIThread.requestAsync.
+    # Responses carry no request id, so requests of the same type are matched
+    # in FIFO order: once a type was requested here, plain requests of it take
+    # their place in the queue too. A plain request sent before the first one
+    # of its type, or a response the server sends unrequested, still resolves
+    # the wrong request: only use it for types answered exactly once per request.
+    # Raises TimeoutError, or ConnectionError when not connected or disconnected.
+    async def requestAsync(self, type, param=None, auth=0, timeout=REQUEST_TIMEOUT):
+        fut = asyncio.get_event_loop().create_future()
+        self.futureTypes.add(type)
+        entry = self._enqueue(type, fut, timeout)
+        if not await self._request(type, param, auth):
+            self._dequeue(type, entry)
+            raise ConnectionError("API not connected: {}".format(type))
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("API request timeout")
+        finally:
+            self._dequeue(type, entry)
+
+    # pending entries are (deadline, future), future is None for plain requests
+    def _enqueue(self, type, fut, timeout):
+        entry = (time.monotonic() + timeout, fut)
+        self.pending.setdefault(type, collections.deque()).append(entry)
+        self.pendingDeadline = min(self.pendingDeadline, entry[0])
+        return entry
+
+    def _dequeue(self, type, entry):
+        q = self.pending.get(type)
+        if q and entry in q:
+            q.remove(entry)
+            if not q:
+                del self.pending[type]
+
+    def _expirePending(self):
+        now = time.monotonic()
+        deadline = float('inf')
+        for type in list(self.pending):
+            q = self.pending[type]
+            while q and q[0][0] < now:
+                fut = q.popleft()[1]
+                if fut and not fut.done():
+                    fut.set_exception(TimeoutError("API request timeout"))
+            if q:
+                deadline = min(deadline, q[0][0])
+            else:
+                del self.pending[type]
+        self.pendingDeadline = deadline
+
+    def _resolvePending(self, data):
+        if self.pendingDeadline < time.monotonic():
+            self._expirePending()
+        q = self.pending.get(data['response'])
+        if not q:
+            return
+        fut = q.popleft()[1]
+        if not q:
+            del self.pending[data['response']]
+        if fut and not fut.done():
+            fut.set_result(data)
+
+    def _failPending(self):
+        pending, self.pending = self.pending, {}
+        self.pendingDeadline = float('inf')
+        for q in pending.values():
+            for deadline, fut in q:
+                if fut and not fut.done():
+                    fut.set_exception(ConnectionError("API disconnected"))
+
+    def _spawn(self, coro):
+        # the event loop only keeps weak references to tasks
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def _call(self, cb, *args):
+        # callbacks may be plain functions or coroutine functions
+        ret = cb(*args)
+        if asyncio.iscoroutine(ret):
+            ret = self._spawn(ret)
+        return ret
+
+    def register(self, devinfo, c=None):
+        if 'addr-key' in devinfo:
+            if c:
+                self.addrkeys[devinfo['addr-key']] = c
+        elif 'addr' in devinfo:
+            if c:
+                self.addrs[devinfo['addr']] = c
+        else:
+            return
+        if not self.devs.update(devinfo):
+            return
+        if self.dbg:
+            self.log.log("Registering device {}".format(devinfo))
+        self.tregdevs = time.monotonic() + REGISTER_DELAY
+        if self.connected and not self.regTimer:
+            self.regTimer = asyncio.get_event_loop().call_later(REGISTER_DELAY, self._onRegisterTimer)
+
+    def _onRegisterTimer(self):
+        delay = self.tregdevs - time.monotonic()
+        if delay > 0:
+            self.regTimer = asyncio.get_event_loop().call_later(delay, self._onRegisterTimer)
+            return
+        self.regTimer = None
+        self._spawn(self.register_commit())
+
+    def subscribe(self, addr, c=None, delay=1):
+        if addr not in self.subsDevs:
+            self.subs.append(addr)
+            self.subsDevs[addr] = []
+        if c and c not in self.subsDevs[addr]:
+            self.subsDevs[addr].append(c)
+        if self.connected and not self.subsTimer:
+            self.subsTimer = asyncio.get_event_loop().call_later(delay, self._onSubscribeTimer)
+
+    def _onSubscribeTimer(self):
+        self.subsTimer = None
+        self._spawn(self.subscribe_commit())
+
+    async def subscribe_commit(self):
+        if self.subs != []:
+            await self.request('status-subscribe', {"status":"detailed", 'addr':self.subs})
+
+    async def register_commit(self):
+        self.tregdevs = 0
+        devs = self.devs.take()
+        if devs != []:
+            self.log.log("Commiting registration of {} devices".format(len(devs)))
+            if not await self.request('she-register-pnp', {"pnp": devs}):
+                self.devs.invalidate()
+
+    def setConnectCallback(self, cb):
+        if cb not in self.connect_cb:
+            self.connect_cb.append(cb)
+        if self.connected:
+            self._call(cb)
+
+    async def events(self, *types, maxsize=0):
+        # async iterator over received messages, optionally filtered by event/response type.
+        # With maxsize a slow consumer loses new messages, counted in self.dropped
+        q = asyncio.Queue(maxsize)
+        listener = (set(types), q)
+        self.listeners.append(listener)
+        try:
+            while True:
+                yield await q.get()
+        finally:
+            self.listeners.remove(listener)
+
+    def reconnect(self):
+        self.connected = False
+        if self.writer:
+            self.writer.close()
+        self._failPending()
+
+    def close(self):
+        self.abort = True
+        self.reconnect()
+
+    async def read(self, auth=0):
+        if not self.reader or (not auth and not self.connected):
+            self.log.log("Read error. API not connected", "RED")
+            return False, None
+        while not self.rxFrames:
+            data = await self.reader.read(self.decoder.bufSize)
+            if not data:
+                return False, None
+            self.decoder.feed(data)
+            try:
+                self.rxFrames.extend(self.decoder.frames())
+            except frame.FrameError as err:
+                self.log.log("Error receiving frame: {}".format(err), 'RED')
+                return False, None
+        return self.decode(self.rxFrames.popleft())
+
+    def decode(self, data):
+        try:
+            if data[:5] == b'<?xml':
+                self.log.log("XML Received")
+                self.xml = data
+                return True, None
+            elif data[:6] == b'-JSON-':
+                res = codec.loads(data, 6)
+            else:
+                res = codec.loads(data)
+        except Exception as err:
+            self.log.log("Error decoding response json: {}. Error: {}".format(data, err), 'RED')
+            return False, None
+        if self.dbg:
+            self.log.log("Received: {}".format(res))
+        return True, res
+
+    def onReceive(self, data):
+        if 'response' in data and self.pending:
+            self._resolvePending(data)
+        if 'event' in data and data['event']=='she-device-is-created':
+            if 'addr-key' in data and data['addr-key'] in self.addrkeys:
+                self._call(self.addrkeys[data['addr-key']]._onCreate, data)
+            elif 'addr' in data and data['addr'] in self.addrs:
+                self._call(self.addrs[data['addr']]._onCreate, data)
+        elif 'event' in data and data['event']=='she-device-status' and 'status' in data:
+            if type(data['status']).__name__ == 'str' and len(data['status'])>3 and data['status'][:2]=='0x':
+                status = bytes().fromhex(data['status'][2:])
+            else:
+                status = data['status']
+            if 'addr-key' in data and data['addr-key'] in self.addrkeys:
+                self._call(self.addrkeys[data['addr-key']]._onStatus, status)
+            elif 'addr' in data and data['addr'] in self.addrs:
+                self._call(self.addrs[data['addr']]._onStatus, status)
+        elif self.subsDevs and (('response' in data and data['response'] == 'status-subscribe') or ('event' in data and data['event'] == 'statuses')) and 'devices' in data:
+            for d in data['devices']:
+                if 'addr' in d and d['addr'] in self.subsDevs:
+                    for cb in self.subsDevs[d['addr']]:
+                        self._call(cb._onStatus, d)
+
+        for types, q in self.listeners:
+            if not types or data.get('event') in types or data.get('response') in types:
+                try:
+                    q.put_nowait(data)
+                except asyncio.QueueFull:
+                    self.dropped += 1
+                    self.log.warning("events() queue full, message dropped ({} total)", self.dropped, sampled=True)
+
+    async def _onConnect(self):
+        if self.name:
+            await self.request('setup', {"appId": self.name})
+        await self.subscribe_commit()
+        await self.register_commit()
+
+    async def connect(self):
+        host = None
+        self.reader = self.writer = None
+        self.decoder.reset()
+        self.rxFrames.clear()
+        self.devs.invalidate()
+        if self.host:
+            host = self.host
+        else:
+            for i in self.unix_sockets:
+                if os.path.exists(i):
+                    host = i
+                    break
+            if not host:
+                self.log.log("Unix sockets dose not exists", 'RED')
+                return False
+        self.log.log("Connecting to {}".format(host), 'BLUE')
+        try:
+            if host[0]=='/': # unix socket
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_unix_connection(host), 5)
+            else: # TCP connection
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, int(self.port)), self.timeout)
+        except Exception as e:
+            self.log.log("API: Connect error: {}".format(e))
+            self.reader = self.writer = None
+            return False
+        if host[0]=='/':
+            self.log.log('API connected', 'GREEN')
+            self.connected = True
+            await self._onConnect()
+            return True
+        await self.request('authorize', {'key':self.key}, auth=True)
+        try:
+            st, js = await asyncio.wait_for(self.read(auth=True), self.timeout)
+        except asyncio.TimeoutError:
+            st, js = False, None
+        if not st:
+            self.log.log("API: Error while receiving auth response", 'RED')
+        elif js and 'response' in js and js['response']=='authorize':
+            if 'result' in js and js['result'] == 'success':
+                self.log.log('API connected and authorized', 'GREEN')
+                self.connected = True
+                await self._onConnect()
+                return True
+            self.log.log('API: auth response error: {}'.format(js), 'RED')
+        else:
+            self.log.log('Waiting for authorize packet. received: {}'.format(js), 'YELLOW')
+        self.writer.close()
+        self.reader = self.writer = None
+        return False
+
+    async def setStatus(self, addr, data):
+        if type(data).__name__ == 'bytes':
+            hex = '0x' + data.hex()
+        elif type(data).__name__ == 'str':
+            hex = '0x' + data.encode().hex()
+        elif type(data).__name__ == 'dict':
+            hex = data
+        else:
+            self.log.log("setStatus Incorrect data type. Expected bytes/str/dict", "RED")
+            return False
+        return await self.request('status-set', {"addr": addr, "status": hex})
+
+    async def run(self):
+        self.abort = False
+        while not self.abort:
+            if not await self.connect():
+                await asyncio.sleep(3)
+                continue
+            for cb in self.connect_cb:
+                ret = self._call(cb)
+                if asyncio.isfuture(ret):
+                    await ret
+            while not self.abort:
+                try:
+                    st, js = await self.read()
+                except Exception as err:
+                    self.log.log("Error reading packet. disconnecting. error: {}".format(err), 'RED')
+                    st = False
+                if not st:
+                    break
+                if js:
+                    self.onReceive(js)
+            self.reconnect()
+            for h in (self.regTimer, self.subsTimer):
+                if h:
+                    h.cancel()
+            self.regTimer = self.subsTimer = None
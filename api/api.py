@@ -1,20 +1,34 @@
 import threading
 import time
-import sys
 import os
 import socket
-import struct
-import json
+import collections
+import asyncio
+import concurrent.futures
 import xml.etree.ElementTree as ET
 
 from api import log
 from api import watcher
+from api import frame
+from api import codec
+from api import metrics
+from api import trace
+from api import registry
+from api import logic
 
 api_class = None
 REGISTER_DELAY = 1
+REQUEST_TIMEOUT = 5
+
+FRAMES = metrics.counter('api_frames_total', 'API frames sent and received', ('direction',))
+BYTES = metrics.counter('api_bytes_total', 'API frame bytes sent and received', ('direction',))
+ERRORS = metrics.counter('api_errors_total', 'API send, frame and decode errors', ('kind',))
+HANDLER = metrics.histogram('api_handler_seconds', 'API message handling time by type', ('type',))
+TX_FRAMES, RX_FRAMES = FRAMES.labels('tx'), FRAMES.labels('rx')
+TX_BYTES, RX_BYTES = BYTES.labels('tx'), BYTES.labels('rx')
 
 class APIThread(object):
-    def __init__(self, host=None, port=None, key=None, name=None, timeout=3, onConnect=None, callBack=None, debug=False, apiPath=None):
+    def __init__(self, host=None, port=None, key=None, name=None, timeout=3, onConnect=None, callBack=None, debug=False, apiPath=None, maxFrame=frame.MAX_FRAME_SIZE, writeQueue=frame.WRITE_QUEUE_SIZE, flushDelay=0):
         global api_class
         api_class = self
         self.log = log.LogThread()
@@ -27,19 +41,37 @@ class APIThread(object):
         self.name = name
         self.dbg = debug
         self.timeout = timeout
-        self.cb = [{'cb':callBack, 'type':None}] if callBack else []
+        self.routes = {
+            'she-device-is-created': [self._onDeviceCreated],
+            'she-device-status': [self._onDeviceStatus],
+            'statuses': [self._onStatuses],
+            'status-subscribe': [self._onStatuses],
+        }
+        self.wildcard = [callBack] if callBack else []
+        self.stats = {}
         self.xmlCB = []
         self.connect_cb = [onConnect] if onConnect else []
         self.connected = False
         self.addrs = {}
         self.addrkeys = {}
-        self.devs = []
+        self.devs = registry.DeviceRegistry()
         self.tregdevs = 0
         self.subs = []
         self.tsubs = 0
         self.subsDevs = {}
         self.xml = None
         self.xmlRoot = None
+        self.xmlIndex = None
+        self.xmlBroken = None
+        self.xmlLock = threading.Lock()
+        self.decoder = frame.FrameDecoder(maxFrame)
+        self.rxFrames = collections.deque()
+        self.writer = frame.FrameWriter(self._onWriteError, writeQueue, flushDelay)
+        self.xmlEvent = threading.Event()
+        self.pending = {}
+        self.pendingLock = threading.Lock()
+        self.pendingDeadline = float('inf')
+        self.futureTypes = set()
 
         if apiPath:
             if apiPath[0]=='/': # UnixSocket
@@ -52,63 +84,51 @@ class APIThread(object):
                 if len(tmp)>2:
                     self.key = tmp[2]
 
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        # the reader wakes up at least every socket timeout, connected or not
+        self.watch = watcher.register('API', self.thread, timeout=watcher.STALL_TIMEOUT, periodic=True, onDeath=watcher.RESTART, restart=self._restartReader)
+        self.thread.start()
+        watcher.register('API-writer', self.writer.thread, onDeath=watcher.RESTART, restart=self.writer.restart)
+        metrics.serve()
+
+    def _restartReader(self):
+        # the connection is kept: the new thread goes on reading where the dead one stopped
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = True
         self.thread.start()
-        watcher.threads['API'] = self.thread
+        return self.thread
 
     def debug(self, d):
         self.dbg = d
 
     def send(self, js):
-        d = b'-JSON-' + json.dumps(js, ensure_ascii=False).encode('utf-8')
+        d = b'-JSON-' + codec.dumps(js)
         if self.dbg:
             self.log.log("API sending: {}".format(d))
-        data = struct.pack("I", len(d)) + d;
-        size = 0
-        while size<len(data):
-            try:
-                ret = self.sock.send(data[size:])
-            except Exception as err:
-                self.log.log("Error sending data to socket: {}".format(err), 'RED')
-                self.reconnect()
-                return False
-            if ret:
-                size = size + ret
-            else:
-                self.log.log("Error sending data. result: {}".format(ret), "RED")
-                return False
+        if not self.writer.send(d):
+            self.log.log("Error sending data. Send queue is full", "RED")
+            ERRORS.labels('send-queue-full').inc()
+            return False
+        TX_FRAMES.inc()
+        TX_BYTES.inc(len(d))
         return True
 
+    def _onWriteError(self, err):
+        self.log.log("Error sending data to socket: {}".format(err), 'RED')
+        self.reconnect()
+
     def register(self, devinfo, c):
         if 'addr-key' in devinfo:
             self.addrkeys[devinfo['addr-key']] = c
-            found = False
-            for i in range(len(self.devs)):
-                if 'addr-key' in self.devs[i] and self.devs[i]['addr-key'] == devinfo['addr-key']:
-                    found = True
-                    self.devs[i] = devinfo
-                    if self.dbg:
-                        self.log.log("Updating device info")
-                    break
-            if not found:
-                if self.dbg:
-                    self.log.log("Registering new device {}".format(devinfo))
-                self.devs.append(devinfo)
         elif 'addr' in devinfo:
             self.addrs[devinfo['addr']] = c
-            found = False
-            for i in range(len(self.devs)):
-                if 'addr' in self.devs[i] and self.devs[i]['addr'] == devinfo['addr']:
-                    found = True
-                    self.devs[i] = devinfo
-                    if self.dbg:
-                        self.log.log("Updating device info")
-                    break
-            if not found:
-                if self.dbg:
-                    self.log.log("Registering new device {}".format(devinfo))
-                self.devs.append(devinfo)
+        else:
+            return
+        if not self.devs.update(devinfo):
+            return
+        if self.dbg:
+            self.log.log("Registering device {}".format(devinfo))
         self.tregdevs = time.monotonic() + REGISTER_DELAY
 
     def subscribe(self, addr, c, delay=1):
@@ -126,12 +146,26 @@ class APIThread(object):
         self.tsubs = 0
 
     def register_commit(self):
-        if self.devs != []:
-            self.log.log("Commiting registration of {} devices".format(len(self.devs)))
-            self.request('she-register-pnp', {"pnp": self.devs})
         self.tregdevs = 0
+        devs = self.devs.take()
+        if devs != []:
+            self.log.log("Commiting registration of {} devices".format(len(devs)))
+            if not self.request('she-register-pnp', {"pnp": devs}):
+                self.devs.invalidate()
+
+    def request(self, type, param=None, auth=0, future=False, timeout=REQUEST_TIMEOUT):
+        if future:
+            return self.requestFuture(type, param, auth, timeout)
+        if type not in self.futureTypes:
+            return self._request(type, param, auth)
+        # keeps the FIFO order of types also requested with a future
+        entry = self._enqueue(type, None, timeout)
+        ret = self._request(type, param, auth)
+        if not ret:
+            self._dequeue(type, entry)
+        return ret
 
-    def request(self, type, param=None, auth=0):
+    def _request(self, type, param, auth):
         if not self.sock or (not auth and not self.connected):
             self.log.log(f"Request error. API not connected: {type}", "RED")
             return False
@@ -142,13 +176,98 @@ class APIThread(object):
             self.log.log("Request: {}".format(q))
         return self.send(q)
 
+    # Returns concurrent.futures.Future resolved with the matching response.
+    # Responses carry no request id, so requests of the same type are matched
+    # in FIFO order: once a type was requested with a future, plain requests
+    # of it take their place in the queue too. A plain request sent before the
+    # first future of its type, or a response the server sends unrequested,
+    # still resolves the wrong future: only use futures for types answered
+    # exactly once per request.
+    def requestFuture(self, type, param=None, auth=0, timeout=REQUEST_TIMEOUT):
+        fut = concurrent.futures.Future()
+        self.futureTypes.add(type)
+        entry = self._enqueue(type, fut, timeout)
+        if not self._request(type, param, auth):
+            self._dequeue(type, entry)
+            if not fut.done():
+                fut.set_exception(ConnectionError("API not connected: {}".format(type)))
+        return fut
+
+    async def requestAsync(self, type, param=None, auth=0, timeout=REQUEST_TIMEOUT):
+        return await asyncio.wait_for(asyncio.wrap_future(self.requestFuture(type, param, auth, timeout)), timeout)
+
+    # pending entries are (deadline, future), future is None for plain requests
+    def _enqueue(self, type, fut, timeout):
+        entry = (time.monotonic() + timeout, fut)
+        with self.pendingLock:
+            self.pending.setdefault(type, collections.deque()).append(entry)
+            self.pendingDeadline = min(self.pendingDeadline, entry[0])
+        return entry
+
+    def _dequeue(self, type, entry):
+        with self.pendingLock:
+            q = self.pending.get(type)
+            if q and entry in q:
+                q.remove(entry)
+                if not q:
+                    del self.pending[type]
+
+    # called by the reader loop once the earliest deadline is over
+    def _expirePending(self):
+        now = time.monotonic()
+        expired = []
+        with self.pendingLock:
+            deadline = float('inf')
+            for type in list(self.pending):
+                q = self.pending[type]
+                while q and q[0][0] < now:
+                    expired.append(q.popleft()[1])
+                if q:
+                    deadline = min(deadline, q[0][0])
+                else:
+                    del self.pending[type]
+            self.pendingDeadline = deadline
+        for fut in expired:
+            if fut and not fut.done():
+                fut.set_exception(TimeoutError("API request timeout"))
+
+    def _resolvePending(self, data):
+        if not self.pending:
+            return
+        with self.pendingLock:
+            q = self.pending.get(data['response'])
+            if not q:
+                return
+            fut = q.popleft()[1]
+            if not q:
+                del self.pending[data['response']]
+        if fut and not fut.done():
+            fut.set_result(data)
+
+    def _failPending(self):
+        with self.pendingLock:
+            pending = self.pending
+            self.pending = {}
+            self.pendingDeadline = float('inf')
+        for q in pending.values():
+            for deadline, fut in q:
+                if fut and not fut.done():
+                    fut.set_exception(ConnectionError("API disconnected"))
+
     def setCallback(self, cb, type=None):
-        self.cb.append({'cb':cb, 'type':type})
+        if type:
+            self.routes.setdefault(type, []).append(cb)
+        else:
+            self.wildcard.append(cb)
+
+    def handlerStats(self):
+        return {k: {'calls': v[0], 'time': v[1]} for k, v in self.stats.items()}
 
     def reconnect(self):
         self.connected = False
         if self.sock:
             self.sock.close()
+        self._failPending()
 
     def setConnectCallback(self, cb):
         if cb not in self.connect_cb:
@@ -160,40 +279,45 @@ class APIThread(object):
         if not self.sock or (not auth and not self.connected):
             self.log.log("Read error. API not connected", "RED")
             return False, None
-        ret = self.sock.recv(4, socket.MSG_WAITALL)
-        if len(ret) == 4:
-            size = struct.unpack("I", ret)[0]
-            if size>0 and size<256000:
-                data = b''
-                while len(data)<size:
-                    ret = self.sock.recv(size-len(data))
-                    #self.log.log("recv = {}".format(ret))
-                    data = data + ret
-                    time.sleep(0.01)
-            #self.log.log("size = {}".format(size))
+        while not self.rxFrames:
+            if not self.decoder.recv(self.sock):
+                return False, None
             try:
-                if data[:5] == b'<?xml':
-                    self.xmlReceived(data)
-                    return True, None
-                elif data[:6] == b'-JSON-':
-                    res = json.loads(data[6:].decode())
-                else:
-                    res = json.loads(data.decode())
-            except Exception as err:
-                self.log.log("Error decoding response json: {}. Error: {}".format(data, err), 'RED')
+                self.rxFrames.extend(self.decoder.frames())
+            except frame.FrameError as err:
+                self.log.log("Error receiving frame: {}".format(err), 'RED')
+                ERRORS.labels('frame').inc()
                 return False, None
-            if self.dbg:
-                self.log.log("Received: {}".format(res if type(res).__name__ != 'bytes' else res[:100]))
-            return True, res
-        else:
-            #self.log.log("recv = {}".format(ret))
-            return False, None
+        data = self.rxFrames.popleft()
+        if trace.ENABLED:
+            trace.begin()
+            with trace.span('api.decode', size=len(data)):
+                return self.decode(data)
+        return self.decode(data)
 
-        return True, None
+    def decode(self, data):
+        RX_FRAMES.inc()
+        RX_BYTES.inc(len(data))
+        try:
+            if data[:5] == b'<?xml':
+                self.xmlReceived(data)
+                return True, None
+            elif data[:6] == b'-JSON-':
+                res = codec.loads(data, 6)
+            else:
+                res = codec.loads(data)
+        except Exception as err:
+            self.log.log("Error decoding response json: {}. Error: {}".format(data, err), 'RED')
+            ERRORS.labels('decode').inc()
+            return False, None
+        if self.dbg:
+            self.log.log("Received: {}".format(res if type(res).__name__ != 'bytes' else res[:100]))
+        return True, res
 
     def xmlReceived(self, xml):
         self.log.log("XML Received")
         self.xml = xml
+        self.xmlEvent.set()
         for cb in self.xmlCB:
             cb(xml)
 
@@ -207,59 +331,97 @@ class APIThread(object):
                 self.xmlCB.append(cb)
 
     def _onXML(self, data):
-        if self.xmlRoot:
-            del self.xmlRoot
-            self.xmlRoot = None
+        # index the new project off the receive thread
+        thread = threading.Thread(target=self._buildIndex, args=(data,))
+        thread.daemon = True
+        thread.start()
 
-    def getXMLRoot(self):
+    def _buildIndex(self, xml):
+        with self.xmlLock:
+            if self.xmlIndex and self.xmlIndex.xml is xml:
+                return self.xmlIndex
+            # a broken project is parsed again only when a new one arrives
+            if self.xmlBroken is xml:
+                return None
+            self.log.log("Parsing XML")
+            try:
+                index = logic.LogicIndex(xml)
+            except ET.ParseError as err:
+                self.log.log("Error parsing XML: {}".format(err), 'RED')
+                self.xmlBroken = xml
+                return None
+            self.xmlIndex = index
+            self.xmlRoot = index.root
+            self.parent_map = index.parents
+            return index
+
+    def getXMLRoot(self, timeout=1):
         self.setXMLcb(self._onXML)
         if not self.xml:
-            for i in range(round(timeout*10)):
-                time.sleep(0.1)
-                if self.xml:
-                    break
-        if not self.xmlRoot and self.xml:
-            self.log.log("Parsing XML")
-            parser = ET.XMLParser(encoding="utf-8")
-            self.xmlRoot = ET.fromstring(self.xml.decode().replace("&", ''), parser=parser)
-            self.parent_map = {c: p for p in self.xmlRoot.iter() for c in p}
-            return self.xmlRoot
-        return None
+            self.xmlEvent.wait(timeout)
+        if self.xml:
+            self._buildIndex(self.xml)
+        return self.xmlRoot
 
     def getItem(self, addr, timeout=1):
-        self.getXMLRoot()
-        if not self.xmlRoot:
+        self.getXMLRoot(timeout)
+        if not self.xmlIndex:
             return None
-        i=self.xmlRoot.findall('.//item[@addr="{}"]'.format(addr))
-        return None if i==[] else i[0].attrib
+        i = self.xmlIndex.find('addr', str(addr))
+        return None if i is None else i.attrib
+
+    def _onDeviceCreated(self, data):
+        if 'addr-key' in data and data['addr-key'] in self.addrkeys:
+            self.addrkeys[data['addr-key']]._onCreate(data)
+        elif 'addr' in data and data['addr'] in self.addrs:
+            self.addrs[data['addr']]._onCreate(data)
+
+    def _onDeviceStatus(self, data):
+        if 'status' not in data:
+            return
+        if type(data['status']).__name__ == 'str' and len(data['status'])>3 and data['status'][:2]=='0x':
+            status = bytes().fromhex(data['status'][2:])
+        else:
+            status = data['status']
+        if 'addr-key' in data and data['addr-key'] in self.addrkeys:
+            self.addrkeys[data['addr-key']]._onStatus(status)
+        elif 'addr' in data and data['addr'] in self.addrs:
+            self.addrs[data['addr']]._onStatus(status)
+
+    def _onStatuses(self, data):
+        if not self.subsDevs or 'devices' not in data:
+            return
+        subsDevs = self.subsDevs
+        for d in data['devices']:
+            cbs = subsDevs.get(d.get('addr'))
+            if cbs:
+                for cb in cbs:
+                    cb._onStatus(d)
 
     def onReceive(self, data):
-        if 'event' in data and data['event']=='she-device-is-created':
-            if 'addr-key' in data and data['addr-key'] in self.addrkeys:
-                self.addrkeys[data['addr-key']]._onCreate(data)
-            elif 'addr' in data and data['addr'] in self.addrs:
-                self.addrs[data['addr']]._onCreate(data)
-        elif 'event' in data and data['event']=='she-device-status' and 'status' in data:
-            if type(data['status']).__name__ == 'str' and len(data['status'])>3 and data['status'][:2]=='0x':
-                status = bytes().fromhex(data['status'][2:])
-            else:
-                status = data['status']
-            if 'addr-key' in data and data['addr-key'] in self.addrkeys:
-                self.addrkeys[data['addr-key']]._onStatus(status)
-            elif 'addr' in data and data['addr'] in self.addrs:
-                self.addrs[data['addr']]._onStatus(status)
-        elif self.subsDevs and (('response' in data and data['response'] == 'status-subscribe') or ('event' in data and data['event'] == 'statuses')) and 'devices' in data:
-            for d in data['devices']:
-                if 'addr' in d and d['addr'] in self.subsDevs:
-                    for cb in self.subsDevs[d['addr']]:
-                        cb._onStatus(d)
-
-        if self.cb!=[]:
-            for cb in self.cb:
-                if not cb['type'] or ('request' in data and data['request']==cb['type']) or ('event' in data and data['event']==cb['type']):
-                    ret = cb['cb'](data)
-                    if type(ret).__name__ == 'dict':
-                        self.send(ret)
+        if 'response' in data:
+            self._resolvePending(data)
+        type = data.get('event') or data.get('response') or data.get('request')
+        handlers = self.routes.get(type)
+        if not handlers and not self.wildcard:
+            return
+        t = time.perf_counter()
+        with trace.span('api.onReceive', type=type):
+            for cb in (handlers or ()):
+                ret = cb(data)
+                if isinstance(ret, dict):
+                    self.send(ret)
+            for cb in self.wildcard:
+                ret = cb(data)
+                if isinstance(ret, dict):
+                    self.send(ret)
+        t = time.perf_counter() - t
+        HANDLER.labels(type).observe(t)
+        st = self.stats.get(type)
+        if not st:
+            st = self.stats[type] = [0, 0.0]
+        st[0] += 1
+        st[1] += t
 
     def _onConnect(self):
         if self.name:
@@ -274,6 +436,9 @@ class APIThread(object):
         if self.sock:
             del self.sock
             self.sock = None
+        self.decoder.reset()
+        self.rxFrames.clear()
+        self.devs.invalidate()
         if self.host:
             host = self.host
         else:
@@ -288,6 +453,7 @@ class APIThread(object):
         if host[0]=='/': # unix socket
             self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             self.sock.settimeout(5)
+            self.writer.attach(self.sock)
             try:
                 self.sock.connect(host)
                 self.connected = True
@@ -303,6 +469,7 @@ class APIThread(object):
         else: # TCP connection
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.settimeout(self.timeout)
+            self.writer.attach(self.sock)
             try:
                 self.sock.connect((self.host,int(self.port)))
             except Exception as e:
@@ -354,6 +521,7 @@ class APIThread(object):
         self.abort = False
         while not self.abort:
             while not self.abort and not self.connected:
+                self.watch.beat()
                 if not self.connect():
                     time.sleep(3)
                     continue
@@ -364,14 +532,19 @@ class APIThread(object):
                         cb()
             js = None
             while True:
+                self.watch.beat()
                 if self.tregdevs and self.tregdevs<time.monotonic():
                      self.register_commit()
                 if self.tsubs and self.tsubs<time.monotonic():
                      self.subscribe_commit()
+                # without traffic a request expires at most one socket timeout late
+                if self.pendingDeadline < time.monotonic():
+                    self._expirePending()
                 try:
                     st, js = self.read()
                     if not st:
                         self.connected = False
+                        self._failPending()
                         break
                 except socket.timeout:
                         #if self.dbg:
@@ -381,8 +554,7 @@ class APIThread(object):
                     st = False
                     self.log.log("Error reading packet. disconnecting. error: {}".format(err), 'RED')
                     self.connected = False
+                    self._failPending()
                     break
                 if st and js:
                     self.onReceive(js)
-                else:
-                    time.sleep(0.01)
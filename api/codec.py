@@ -0,0 +1,41 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# JSON codec for the API wire protocol. Uses orjson or ujson when installed,
+# stdlib json otherwise. dumps() returns utf-8 bytes, loads() parses bytes
+# starting at `start` without decoding them to str first.
+
+def _std_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def _std_loads(data, start=0):
+    return json.loads(data[start:] if start else data)
+
+if orjson:
+    name = 'orjson'
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data, start=0):
+        return orjson.loads(memoryview(data)[start:] if start else data)
+elif ujson:
+    name = 'ujson'
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def loads(data, start=0):
+        return ujson.loads(data[start:] if start else data)
+else:
+    name = 'json'
+    dumps = _std_dumps
+    loads = _std_loads
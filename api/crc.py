@@ -0,0 +1,42 @@
+# Modbus RTU CRC16 (poly 0xA001 reflected, init 0xFFFF).
+# Uses the crcmod C extension when it is installed, a 256-entry table otherwise.
+
+def _mkTable():
+    table = []
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = (c >> 1) ^ 0xA001 if c & 1 else c >> 1
+        table.append(c)
+    return table
+
+TABLE = _mkTable()
+
+def crc16_table(data, crc=0xFFFF):
+    # data: bytes, bytearray or memoryview
+    table = TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+try:
+    import crcmod
+    import crcmod._crcfunext
+    _ext = crcmod.mkCrcFun(0x18005, rev=True, initCrc=0xFFFF, xorOut=0x0000)
+except ImportError:
+    _ext = None
+
+if _ext:
+    name = 'crcmod'
+
+    def crc16(data):
+        if type(data) is memoryview:
+            data = data.tobytes()
+        return _ext(data)
+else:
+    name = 'table'
+    crc16 = crc16_table
+
+def check(frame):
+    # True if the last two bytes of frame are its valid CRC (little endian)
+    return len(frame) > 2 and crc16(memoryview(frame)[:-2]) == (frame[-2] | (frame[-1] << 8))
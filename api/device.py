@@ -1,14 +1,22 @@
-import time
-import datetime
-import sys
-import json
 import threading
-import queue
+import time
 from api import api
 from api import watcher
+from api import metrics
+from api import trace
+from api import pool as workers
+
+# Default pool for threaded devices. When set (e.g. POOL = pool.WorkerPool(8)),
+# devices share its workers instead of starting a thread each. pool=True
+# selects the shared pool for a single device.
+POOL = None
+DROP_LOG_INTERVAL = 60 # seconds between queue overflow warnings of a device
+
+QUEUE_DEPTH = metrics.gauge('device_queue_depth', 'Statuses waiting in the device queue', ('device',))
+QUEUE_DROPPED = metrics.counter('device_queue_dropped_total', 'Statuses dropped by the device queue overflow policy', ('device',))
 
 class device(object):
-    def __init__(self, addr=None, addrkey=None, create={}, threaded=True, onStatus=None, onConnect=None):
+    def __init__(self, addr=None, addrkey=None, create={}, threaded=True, onStatus=None, onConnect=None, pool=None, overflow=workers.DROP_OLDEST):
         self.api = api.api_class
         self.log = api.api_class.log
         self.addr = addr
@@ -17,14 +25,33 @@ class device(object):
         self.threaded = threaded
         self.statusCB = onStatus
         self.connectCB = onConnect
-        if self.threaded:
-            self.q = queue.Queue(10)
+        self.thread = None
+        self.droppedLogged = 0
+        self.dropLogTime = 0
+        pool = pool or POOL
+        if pool is True:
+            pool = workers.shared()
+        if self.threaded and pool:
+            self.q = pool.mailbox(self._onQueued, policy=overflow)
+        elif self.threaded:
+            self.q = workers.Mailbox(policy=overflow)
             self.thread = threading.Thread(target=self.loop, args=())
             self.thread.daemon = True
+            self.watch = watcher.register('dev-{}-{}'.format(addrkey, addr), self.thread, timeout=watcher.STALL_TIMEOUT, onDeath=watcher.RESTART, restart=self._restartLoop)
             self.thread.start()
-            watcher.threads['dev-{}-{}'.format(addrkey, addr)] = self.thread
+        if self.threaded:
+            name = addrkey or addr
+            QUEUE_DEPTH.labels(name).setFunction(self.q.qsize)
+            QUEUE_DROPPED.labels(name).setFunction(lambda: self.q.dropped)
         self.api.setConnectCallback(self._onConnect)
 
+    def _restartLoop(self):
+        # statuses queued meanwhile are kept
+        self.thread = threading.Thread(target=self.loop, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
     def _onConnect(self):
         if self.create!={}:
             if self.addrkey:
@@ -50,10 +77,31 @@ class device(object):
 
     def _onStatus(self, data):
         if self.threaded:
-            self.q.put(data, block=True, timeout=0.1)
+            # never wait for the consumer on the API reader thread
+            self.q.put(trace.carry(data), block=threading.current_thread() is not self.api.thread)
+            if self.q.dropped != self.droppedLogged and time.monotonic() >= self.dropLogTime:
+                self._logDropped()
         else:
             self.onStatus(data)
 
+    def _logDropped(self):
+        # at most once per DROP_LOG_INTERVAL, the total is in queueStats() and the metrics
+        dropped = self.q.dropped
+        self.log.warning("Device {} queue full ({}): {} statuses dropped, {} in total", self.addrkey or self.addr,
+                         self.q.policy, dropped - self.droppedLogged, dropped)
+        self.droppedLogged = dropped
+        self.dropLogTime = time.monotonic() + DROP_LOG_INTERVAL
+
+    def _onQueued(self, data):
+        data = trace.resume(data)
+        with trace.span('device.onStatus', device=self.addrkey or self.addr):
+            return self.onStatus(data)
+
+    def queueStats(self):
+        if not self.threaded:
+            return None
+        return {'size': self.q.qsize(), 'dropped': self.q.dropped, 'coalesced': self.q.coalesced}
+
     def onStatusCallBack(self, cb):
         self.statusCB = cb
 
@@ -64,19 +112,24 @@ class device(object):
         return True
 
     def setStatus(self, data):
-        self.log.log("Sending status: {}".format(data))
-        if type(data).__name__ == 'bytes':
-            data = '0x'+data.hex()
-        if self.create=={}:
-            self.api.request('status-set', {"addr": self.addr, "status": data})
-        else:
-            if self.addrkey:
-                self.api.request('she-device-status', {"addr-key": self.addrkey, "status": data})
-            elif self.addr:
-                self.api.request('she-device-status', {"addr": self.addr, "status": data})
+        self.log.info("Sending status: {}", data, sampled=True)
+        with trace.span('device.setStatus'):
+            if type(data).__name__ == 'bytes':
+                data = '0x'+data.hex()
+            if self.create=={}:
+                self.api.request('status-set', {"addr": self.addr, "status": data})
+            else:
+                if self.addrkey:
+                    self.api.request('she-device-status', {"addr-key": self.addrkey, "status": data})
+                elif self.addr:
+                    self.api.request('she-device-status', {"addr": self.addr, "status": data})
 
     def loop(self):
         while True:
-            ret = self.q.get(block=True, timeout=None)
+            ret = self.q.get()
             if ret:
-                self.onStatus(ret)
+                self.watch.busy()
+                try:
+                    self._onQueued(ret)
+                finally:
+                    self.watch.idle()
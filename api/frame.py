@@ -0,0 +1,171 @@
+import struct
+import threading
+import queue
+import time
+
+MAX_FRAME_SIZE = 32*1024*1024
+BUFFER_SIZE = 65536
+WRITE_QUEUE_SIZE = 1000
+WRITE_TIMEOUT = 5
+MAX_BATCH = 256 # frames per sendmsg, two buffers each (IOV_MAX is 1024 on linux)
+
+HEADER = struct.Struct("I")
+
+class FrameError(Exception):
+    pass
+
+# Length-prefixed frame decoder. Socket data is received straight into one
+# growable bytearray and every complete frame found in it is returned at once.
+class FrameDecoder(object):
+    def __init__(self, maxSize=MAX_FRAME_SIZE, bufSize=BUFFER_SIZE):
+        self.maxSize = maxSize
+        self.bufSize = bufSize
+        self.reset()
+
+    def reset(self):
+        self.buf = bytearray(self.bufSize)
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        return self.end - self.start
+
+    def _reserve(self, size):
+        # make room for at least `size` more bytes after self.end
+        if len(self.buf) - self.end >= size:
+            return
+        n = self.end - self.start
+        if self.start:
+            self.buf[:n] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = n
+        if len(self.buf) - n < size:
+            self.buf.extend(bytes(n + size - len(self.buf)))
+
+    def recv(self, sock):
+        # reads as much as the socket has. Returns number of received bytes, 0 on EOF
+        self._reserve(self.bufSize)
+        with memoryview(self.buf) as mv:
+            n = sock.recv_into(mv[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self.buf[self.end:self.end+len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        res = []
+        # one copy per frame; the view is released before the buffer is resized
+        with memoryview(self.buf) as mv:
+            while self.end - self.start >= HEADER.size:
+                size = HEADER.unpack_from(mv, self.start)[0]
+                if size <= 0 or size > self.maxSize:
+                    raise FrameError("Incorrect frame size: {}".format(size))
+                if self.end - self.start - HEADER.size < size:
+                    break
+                begin = self.start + HEADER.size
+                res.append(bytes(mv[begin:begin+size]))
+                self.start = begin + size
+        if self.end - self.start >= HEADER.size:
+            # wait for the rest of an incomplete frame with room for all of it
+            size = HEADER.unpack_from(self.buf, self.start)[0]
+            self._reserve(HEADER.size + size - (self.end - self.start))
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.bufSize*16:
+                # do not keep the memory of a single huge frame around
+                self.buf = bytearray(self.bufSize)
+        return res
+
+def encode(data):
+    return HEADER.pack(len(data)) + data
+
+# Outbound frames are queued by any thread and written by a single writer
+# thread, several frames per sendmsg call. A frame is never interleaved with
+# another one; a full queue blocks the sender up to `timeout` seconds.
+class FrameWriter(object):
+    def __init__(self, onError=None, maxQueue=WRITE_QUEUE_SIZE, flushDelay=0, timeout=WRITE_TIMEOUT):
+        self.onError = onError
+        self.flushDelay = flushDelay
+        self.timeout = timeout
+        self.sock = None
+        self.q = queue.Queue(maxQueue)
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def restart(self):
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def attach(self, sock):
+        # frames queued for the previous connection are dropped by the writer
+        self.sock = sock
+
+    def send(self, data, timeout=None):
+        try:
+            self.q.put((self.sock, HEADER.pack(len(data)), data), block=True, timeout=self.timeout if timeout is None else timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def flush(self):
+        self.q.join()
+
+    def _collect(self):
+        batch = [self.q.get()]
+        if self.flushDelay:
+            deadline = time.monotonic() + self.flushDelay
+            while len(batch) < MAX_BATCH:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    batch.append(self.q.get(timeout=left))
+                except queue.Empty:
+                    break
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(self.q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, sock, bufs):
+        if not hasattr(sock, 'sendmsg'):
+            sock.sendall(b''.join(bufs))
+            return
+        bufs = [memoryview(b) for b in bufs]
+        i = 0
+        while i < len(bufs):
+            n = sock.sendmsg(bufs[i:])
+            if not n:
+                raise ConnectionError("socket connection broken")
+            while n and n >= len(bufs[i]):
+                n -= len(bufs[i])
+                i += 1
+            if n:
+                bufs[i] = bufs[i][n:]
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            sock = self.sock
+            bufs = []
+            for s, header, data in batch:
+                if s is sock:
+                    bufs.append(header)
+                    bufs.append(data)
+            try:
+                if sock and bufs:
+                    self._write(sock, bufs)
+            except Exception as err:
+                if self.onError and sock is self.sock:
+                    self.onError(err)
+            finally:
+                for i in range(len(batch)):
+                    self.q.task_done()
@@ -0,0 +1,143 @@
+import threading
+import time
+
+from api import metrics
+
+ALPHA = 1/8 # RTT smoothing, as TCP retransmission timer (RFC 6298)
+BETA = 1/4
+K = 4 # variance margin of the timeout
+MIN_TIMEOUT = 0.1
+SAMPLES = 8 # replies measured before the timeout adapts
+FAILURES = 3 # consecutive timeouts that open the circuit
+BACKOFF = 1 # first open period, doubled by every failed probe
+MAX_BACKOFF = 60
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+STATE = metrics.gauge('slave_circuit_state', 'Circuit breaker state of a slave: 0 closed, 1 half-open, 2 open', ('device', 'slave'))
+TIMEOUT = metrics.gauge('slave_timeout_seconds', 'Reply timeout a slave currently gets', ('device', 'slave'))
+
+# Health of one slave: smoothed round trip time for an adaptive timeout and
+# a circuit breaker. A timeout doubles the adaptive timeout up to the
+# configured one; timeouts at the configured one open the circuit. An open
+# circuit rejects requests until its backoff is over, then lets a single
+# probe through; a probe reply closes it again.
+class Slave(object):
+    def __init__(self, failures=FAILURES, backoff=BACKOFF, maxBackoff=MAX_BACKOFF):
+        self.failures = failures
+        self.minBackoff = backoff
+        self.maxBackoff = maxBackoff
+        self.backoff = backoff
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = None
+        self.limit = None
+        self.state = CLOSED
+        self.timeouts = 0 # consecutive
+        self.openUntil = 0
+        self.ok = 0
+        self.failed = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def timeout(self, default):
+        # configured timeout is the upper bound, probes always get all of it
+        self.limit = default
+        if self.rto is None or self.state != CLOSED:
+            return default
+        return min(default, self.rto)
+
+    # timeout of the next request, without updating the limit
+    def current(self):
+        if self.rto is None or self.state != CLOSED:
+            return self.limit if self.limit is not None else float('nan')
+        return min(self.limit, self.rto) if self.limit else self.rto
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= self.openUntil:
+                self.state = HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    # Fast check before queueing a request, does not take the probe
+    def blocked(self):
+        with self.lock:
+            if self.state == OPEN and time.monotonic() < self.openUntil:
+                self.rejected += 1
+                return True
+            return False
+
+    def success(self, rtt):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt/2
+            else:
+                self.rttvar += BETA*(abs(self.srtt - rtt) - self.rttvar)
+                self.srtt += ALPHA*(rtt - self.srtt)
+            if self.ok >= SAMPLES or self.rto is not None:
+                self.rto = max(MIN_TIMEOUT, self.srtt + K*self.rttvar)
+            self.ok += 1
+            self.timeouts = 0
+            self.state = CLOSED
+            self.backoff = self.minBackoff
+
+    def failure(self):
+        with self.lock:
+            self.failed += 1
+            self.timeouts += 1
+            if self.state == HALF_OPEN:
+                self.backoff = min(self.backoff*2, self.maxBackoff)
+            elif self.rto is not None and self.limit and self.rto < self.limit:
+                # a slow slave gets more time with the next request
+                self.rto = min(self.rto*2, self.limit)
+                return
+            elif self.timeouts < self.failures:
+                return
+            self.state = OPEN
+            self.openUntil = time.monotonic() + self.backoff
+
+    # Request ended without an answer for reasons other than the slave (lost
+    # connection, ...): a probe in flight is given back to the next request
+    def cancel(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def stats(self):
+        return {'state': self.state, 'rtt': self.srtt, 'rttvar': self.rttvar, 'timeout': self.rto, 'ok': self.ok,
+                'failed': self.failed, 'rejected': self.rejected,
+                'retry': max(0, self.openUntil - time.monotonic()) if self.state == OPEN else 0}
+
+# Slave health by address (modbus address, unit ID, ...). With a name the
+# state and timeout of every slave are exported as gauges labelled with it.
+class Health(object):
+    def __init__(self, failures=FAILURES, backoff=BACKOFF, maxBackoff=MAX_BACKOFF, name=None):
+        self.name = name
+        self.failures = failures
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.slaves = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        s = self.slaves.get(key)
+        if s is None:
+            with self.lock:
+                s = self.slaves.get(key)
+                if s is None:
+                    s = self.slaves[key] = Slave(self.failures, self.backoff, self.maxBackoff)
+                    if self.name is not None:
+                        STATE.labels(self.name, key).setFunction(lambda: STATES[s.state])
+                        TIMEOUT.labels(self.name, key).setFunction(s.current)
+        return s
+
+    def stats(self):
+        return {k: s.stats() for k, s in list(self.slaves.items())}
@@ -1,7 +1,236 @@
 import time
 import datetime
 import sys
+import os
 import json
+import threading
+import queue
+import atexit
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+NAMES = {v: k for k, v in LEVELS.items()}
+
+COLORS = {
+    'WHITE': "\u001b[37;1m",
+    'RED': "\u001b[31;1m",
+    'GREEN': "\u001b[32;1m",
+    'YELLOW': "\u001b[33;1m",
+    'BLUE': "\u001b[34;1m",
+}
+RESET = "\u001b[0m"
+# level of messages logged with a color only
+COLOR_LEVELS = {'RED': ERROR, 'YELLOW': WARNING}
+LEVEL_COLORS = {DEBUG: 'WHITE', INFO: 'WHITE', WARNING: 'YELLOW', ERROR: 'RED'}
+
+QUEUE_SIZE = 10000
+BATCH = 256 # messages per write and flush
+FLUSH_TIMEOUT = 2
+
+SAMPLE = (10, 100) # default rate of sampled call sites: first N, then one in M
+SAMPLE_INTERVAL = 60 # seconds, rate counters are reset and suppressed messages reported
+
+# Environment: SH_LOG_LEVEL=DEBUG|INFO|WARNING|ERROR, SH_LOG_JSON=1 for JSON lines,
+# SH_LOG_RATE="modbustcp=5/1000,api.device=off,api=20/50" per module rate of
+# every call site (the longest module prefix wins, '*' matches any module,
+# 'off' disables the limit)
+LEVEL = LEVELS.get(os.environ.get('SH_LOG_LEVEL', 'INFO').upper(), INFO)
+JSON = os.environ.get('SH_LOG_JSON', '') not in ('', '0', 'false', 'no')
+
+def parseRates(spec):
+    rates = {}
+    for item in spec.replace(';', ',').split(','):
+        if '=' not in item:
+            continue
+        module, rate = (x.strip() for x in item.split('=', 1))
+        if rate in ('off', '0', ''):
+            rates[module] = None
+            continue
+        n, _, m = rate.partition('/')
+        rates[module] = (int(n), int(m or 0))
+    return rates
+
+RATES = parseRates(os.environ.get('SH_LOG_RATE', ''))
+
+def moduleName(frame):
+    name = frame.f_globals.get('__name__', '')
+    if name == '__main__':
+        # plugin scripts run as __main__: name them after their directory and file
+        path = os.path.splitext(os.path.abspath(frame.f_code.co_filename))[0]
+        name = '.'.join(path.split(os.sep)[-2:])
+    return name
+
+class Site(object):
+    __slots__ = ('msg', 'level', 'color', 'rate', 'count', 'suppressed')
+
+    def __init__(self, msg, level, color, rate):
+        self.msg = msg
+        self.level = level
+        self.color = color
+        self.rate = rate
+        self.count = 0
+        self.suppressed = 0
+
+# Per call site rate limit: the first N messages of every SAMPLE_INTERVAL are
+# logged, then one in M. The writer reports how many were suppressed at the
+# end of the interval. Counters are not locked, a lost increment only lets
+# one message more through.
+class Sampler(object):
+    def __init__(self):
+        self.sites = {}
+
+    def rate(self, module, sampled):
+        best = None
+        for k in RATES:
+            if (module == k or module.startswith(k + '.')) and (best is None or len(k) > len(best)):
+                best = k
+        if best is not None:
+            return RATES[best]
+        if '*' in RATES:
+            return RATES['*']
+        return SAMPLE if sampled else None
+
+    def allow(self, frame, msg, level, color, sampled):
+        key = (frame.f_code, frame.f_lineno)
+        site = self.sites.get(key)
+        if site is None:
+            site = self.sites.setdefault(key, Site(msg, level, color, self.rate(moduleName(frame), sampled)))
+        if site.rate is None:
+            return True
+        site.count += 1
+        n, m = site.rate
+        if site.count <= n or (m and (site.count - n) % m == 0):
+            return True
+        site.suppressed += 1
+        return False
+
+    def summaries(self):
+        res = []
+        for site in list(self.sites.values()):
+            if site.suppressed:
+                res.append((time.time(), site.level, site.color, "Suppressed {} similar messages: {}", (site.suppressed, site.msg), None))
+            site.count = 0
+            site.suppressed = 0
+        return res
+
+    def reset(self):
+        self.sites = {}
+
+sampler = Sampler()
+
+# Log records of all LogThread instances are queued and written by one
+# background thread, several per write and flush. The caller only takes a
+# timestamp: formatting happens on the writer. A full queue drops messages
+# and the number of dropped ones is logged afterwards.
+class Writer(object):
+    def __init__(self, stream=None, maxQueue=QUEUE_SIZE):
+        self.stream = stream
+        self.q = queue.Queue(maxQueue)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.nextSummary = time.monotonic() + SAMPLE_INTERVAL
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(), name='log-writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def put(self, record):
+        if self.thread is None:
+            self.start()
+        try:
+            self.q.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        # waits until everything queued so far is written
+        if self.thread is None or not self.thread.is_alive():
+            return False
+        done = threading.Event()
+        try:
+            self.q.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def format(self, record):
+        t, level, color, msg, args, data = record
+        try:
+            if args:
+                msg = msg.format(*args)
+            if JSON:
+                js = {'ts': t, 'level': NAMES.get(level, level), 'msg': msg}
+                if data:
+                    js['data'] = data
+                return json.dumps(js, default=str) + '\n'
+            if data:
+                msg = msg + json.dumps(data, indent=4)
+        except Exception as err:
+            msg = "Log format error: {!r} {!r}: {}".format(msg, args, err)
+        ts = datetime.datetime.fromtimestamp(t)
+        return "{}.{:03.0f}  {}{}{}\n".format(ts.strftime("%H:%M:%S"), ts.microsecond / 1000.0, COLORS.get(color, RESET), msg, RESET)
+
+    def write(self, lines):
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(''.join(lines))
+            stream.flush()
+        except Exception:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.q.get(timeout=max(0, self.nextSummary - time.monotonic()))]
+            except queue.Empty:
+                batch = []
+            if time.monotonic() >= self.nextSummary:
+                self.nextSummary = time.monotonic() + SAMPLE_INTERVAL
+                batch += sampler.summaries()
+            while len(batch) < BATCH:
+                try:
+                    batch.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            events = []
+            for r in batch:
+                if isinstance(r, threading.Event):
+                    events.append(r)
+                else:
+                    lines.append(self.format(r))
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self.format((time.time(), WARNING, 'YELLOW', "Log queue full, {} messages dropped".format(dropped), (), None)))
+            if lines:
+                self.write(lines)
+            for e in events:
+                e.set()
+
+writer = Writer()
+atexit.register(writer.flush)
+
+def flush(timeout=FLUSH_TIMEOUT):
+    return writer.flush(timeout)
+
+def configure(level=None, jsonLines=None, stream=None, rates=None):
+    global LEVEL, JSON, RATES
+    if rates is not None:
+        RATES = parseRates(rates) if isinstance(rates, str) else dict(rates)
+        sampler.reset()
+    if level is not None:
+        LEVEL = LEVELS.get(level.upper(), INFO) if isinstance(level, str) else level
+    if jsonLines is not None:
+        JSON = jsonLines
+    if stream is not None:
+        writer.stream = stream
 
 class LogThread(object):
     def __init__(self):
@@ -11,22 +240,35 @@ class LogThread(object):
     def silent(self, s):
         self.sln = s
 
-    def log(self, msg, color='WHITE', dict=None):
-        if self.sln:
+    def enabled(self, level):
+        return not self.sln and level >= LEVEL
+
+    # sampled=True rate limits the call site with SAMPLE unless SH_LOG_RATE
+    # sets a rate for its module
+    def log(self, msg, color='WHITE', dict=None, level=None, args=(), sampled=False, depth=1):
+        if level is None:
+            level = COLOR_LEVELS.get(color, INFO)
+        if not self.enabled(level):
+            return
+        # the call site is looked up only for messages that pass the level
+        if (sampled or RATES) and not sampler.allow(sys._getframe(depth), msg, level, color, sampled):
             return
-        if dict:
-            msg = msg + json.dumps(dict, indent=4)
-        r="\u001b[0m"
-        c=r
-        if color=='WHITE':
-            c="\u001b[37;1m"
-        if color=='RED':
-            c="\u001b[31;1m"
-        if color=='GREEN':
-            c="\u001b[32;1m"
-        if color=='YELLOW':
-            c="\u001b[33;1m"
-        if color=='BLUE':
-            c="\u001b[34;1m"
-        print("{}.{:03.0f}  {}{}{}".format(datetime.datetime.now().strftime("%H:%M:%S"), datetime.datetime.now().microsecond / 1000.0, c, msg, r))
-        sys.stdout.flush()
+        writer.put((time.time(), level, color, msg, args, dict))
+
+    # msg is formatted with str.format(*args) on the writer thread, so args
+    # must not be changed after the call
+    def debug(self, msg, *args, color=None, sampled=False):
+        if self.enabled(DEBUG):
+            self.log(msg, color or LEVEL_COLORS[DEBUG], level=DEBUG, args=args, sampled=sampled, depth=2)
+
+    def info(self, msg, *args, color=None, sampled=False):
+        if self.enabled(INFO):
+            self.log(msg, color or LEVEL_COLORS[INFO], level=INFO, args=args, sampled=sampled, depth=2)
+
+    def warning(self, msg, *args, color=None, sampled=False):
+        if self.enabled(WARNING):
+            self.log(msg, color or LEVEL_COLORS[WARNING], level=WARNING, args=args, sampled=sampled, depth=2)
+
+    def error(self, msg, *args, color=None, sampled=False):
+        if self.enabled(ERROR):
+            self.log(msg, color or LEVEL_COLORS[ERROR], level=ERROR, args=args, sampled=sampled, depth=2)
@@ -0,0 +1,47 @@
+import xml.etree.ElementTree as ET
+
+INDEX_ATTRS = ('addr', 'id', 'name')
+INDEX_TAGS = ('item',)
+CHUNK_SIZE = 65536
+
+# Logic XML parsed incrementally into an element tree plus lookup tables:
+# items by attribute value and a parent map.
+class LogicIndex(object):
+    def __init__(self, xml, attrs=INDEX_ATTRS, tags=INDEX_TAGS):
+        self.xml = xml
+        self.root = None
+        self.parents = {}
+        self.index = {a: {} for a in attrs}
+        parser = ET.XMLPullParser(('start', 'end'))
+        stack = []
+        for i in range(0, len(xml), CHUNK_SIZE):
+            # project XML may contain unescaped '&', it is dropped as before
+            parser.feed(xml[i:i+CHUNK_SIZE].replace(b'&', b''))
+            self._events(parser, stack, tags)
+        parser.close()
+        self._events(parser, stack, tags)
+
+    def _events(self, parser, stack, tags):
+        for ev, elem in parser.read_events():
+            if ev == 'start':
+                if stack:
+                    self.parents[elem] = stack[-1]
+                else:
+                    self.root = elem
+                stack.append(elem)
+                if elem.tag in tags:
+                    for a, idx in self.index.items():
+                        v = elem.get(a)
+                        if v is not None and v not in idx:
+                            idx[v] = elem
+            else:
+                stack.pop()
+
+    def find(self, attr, value):
+        idx = self.index.get(attr)
+        if idx is None:
+            return self.root.find('.//item[@{}="{}"]'.format(attr, value))
+        return idx.get(value)
+
+    def parent(self, elem):
+        return self.parents.get(elem)
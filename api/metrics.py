@@ -0,0 +1,278 @@
+import math
+import os
+import threading
+import socketserver
+import http.server
+
+# Histogram buckets: HDR-style log-linear, SUB linear buckets per power of two
+# between LOWEST and HIGHEST seconds (about 8 us .. 128 s by default)
+LOWEST = 2**-17
+HIGHEST = 2**7
+SUB = 2
+
+# Environment: SH_METRICS=host:port or /path/to/unix.sock serves Prometheus text format
+ENDPOINT = os.environ.get('SH_METRICS')
+
+# Counters and gauges are updated without locks: the GIL keeps values
+# consistent and a lost increment under heavy contention is acceptable for
+# monitoring. Locks are only taken to create a labelled child.
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelNames:
+            self.children[()] = self.child()
+
+    def child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        c = self.children.get(values)
+        if c is None:
+            if len(values) != len(self.labelNames):
+                raise ValueError("{} expects labels {}".format(self.name, self.labelNames))
+            with self.lock:
+                c = self.children.setdefault(values, self.child())
+        return c
+
+    def remove(self, *values):
+        with self.lock:
+            self.children.pop(tuple(str(v) for v in values), None)
+
+    def _labels(self, values, extra=None):
+        pairs = list(zip(self.labelNames, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs) + '}'
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        for values, c in list(self.children.items()):
+            lines += c.render(self, values)
+        return lines
+
+    # shortcuts for metrics without labels
+    def inc(self, n=1):
+        self.children[()].inc(n)
+
+    def set(self, v):
+        self.children[()].set(v)
+
+    def observe(self, v):
+        self.children[()].observe(v)
+
+class Value(object):
+    __slots__ = ('value', 'fn')
+
+    def __init__(self):
+        self.value = 0
+        self.fn = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    # the value is read when metrics are collected, nothing to do on the hot path
+    def setFunction(self, fn):
+        self.fn = fn
+
+    def get(self):
+        if self.fn:
+            try:
+                return self.fn()
+            except Exception:
+                return float('nan')
+        return self.value
+
+    def render(self, m, values):
+        return ['{}{} {}'.format(m.name, m._labels(values), self.get())]
+
+class CounterValue(Value):
+    __slots__ = ()
+
+class GaugeValue(Value):
+    __slots__ = ()
+
+    def set(self, v):
+        self.value = v
+
+    def dec(self, n=1):
+        self.value -= n
+
+class HistogramValue(object):
+    __slots__ = ('counts', 'sum', 'count', 'lowExp', 'octaves', 'sub')
+
+    def __init__(self, lowest=LOWEST, highest=HIGHEST, sub=SUB):
+        self.lowExp = math.frexp(lowest)[1]
+        self.octaves = math.frexp(highest)[1] - self.lowExp
+        self.sub = sub
+        # [0] below lowest, [-1] above highest
+        self.counts = [0] * (self.octaves*sub + 2)
+        self.sum = 0.0
+        self.count = 0
+
+    def index(self, v):
+        if v <= 0:
+            return 0
+        m, e = math.frexp(v)
+        o = e - self.lowExp
+        if o < 0:
+            return 0
+        if o >= self.octaves:
+            return len(self.counts) - 1
+        # m is in [0.5, 1): linear buckets inside the octave
+        return 1 + o*self.sub + int((m - 0.5)*2*self.sub)
+
+    def bound(self, i):
+        # upper bound of bucket i (1 .. len-2)
+        o, s = divmod(i - 1, self.sub)
+        return math.ldexp(0.5 + (s + 1)/(2*self.sub), o + self.lowExp)
+
+    def observe(self, v):
+        self.counts[self.index(v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def quantile(self, q):
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q*total
+        acc = 0
+        for i, n in enumerate(counts):
+            acc += n
+            if acc >= rank:
+                if i == 0:
+                    return math.ldexp(0.5, self.lowExp)
+                if i == len(counts) - 1:
+                    return float('inf')
+                return self.bound(i)
+        return float('inf')
+
+    def render(self, m, values):
+        counts = list(self.counts)
+        lines = []
+        acc = counts[0]
+        for i in range(1, len(counts) - 1):
+            acc += counts[i]
+            lines.append('{}_bucket{} {}'.format(m.name, m._labels(values, ('le', repr(self.bound(i)))), acc))
+        acc += counts[-1]
+        lines.append('{}_bucket{} {}'.format(m.name, m._labels(values, ('le', '+Inf')), acc))
+        lines.append('{}_sum{} {}'.format(m.name, m._labels(values), self.sum))
+        lines.append('{}_count{} {}'.format(m.name, m._labels(values), acc))
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+
+    def child(self):
+        return CounterValue()
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def child(self):
+        return GaugeValue()
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help='', labels=(), lowest=LOWEST, highest=HIGHEST, sub=SUB):
+        self.range = (lowest, highest, sub)
+        Metric.__init__(self, name, help, labels)
+
+    def child(self):
+        return HistogramValue(*self.range)
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kw):
+        m = self.metrics.get(name)
+        if m is None:
+            with self.lock:
+                m = self.metrics.get(name)
+                if m is None:
+                    m = self.metrics[name] = cls(name, help, labels, **kw)
+        if not isinstance(m, cls):
+            raise ValueError("Metric {} is already registered as {}".format(name, m.type))
+        return m
+
+    def counter(self, name, help='', labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=(), **kw):
+        return self._get(Histogram, name, help, labels, **kw)
+
+    def render(self):
+        lines = []
+        for m in list(self.metrics.values()):
+            lines += m.render()
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, help='', labels=()):
+    return REGISTRY.counter(name, help, labels)
+
+def gauge(name, help='', labels=()):
+    return REGISTRY.gauge(name, help, labels)
+
+def histogram(name, help='', labels=(), **kw):
+    return REGISTRY.histogram(name, help, labels, **kw)
+
+def render():
+    return REGISTRY.render()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects an address tuple
+        sock, _ = socketserver.UnixStreamServer.get_request(self)
+        return sock, ('local', 0)
+
+server = None
+
+# Serves render() over HTTP on host:port, or on a unix socket path
+def serve(addr=None):
+    global server
+    addr = addr or ENDPOINT
+    if not addr or server:
+        return server
+    if addr[0] == '/':
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = UnixHTTPServer(addr, Handler)
+    else:
+        host, _, port = addr.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), Handler)
+    t = threading.Thread(target=server.serve_forever, args=(), name='metrics')
+    t.daemon = True
+    t.start()
+    return server
@@ -6,10 +6,33 @@ import socket
 import struct
 import json, yaml
 import requests
-import crcmod
+import queue
 
 from api import api
 from api import device
+from api import watcher
+from api import crc
+from api import regs
+from api import health
+from api import metrics
+
+RTT = metrics.histogram('modbus_rtt_seconds', 'Modbus request round trip time', ('device', 'slave'))
+REQUESTS = metrics.counter('modbus_requests_total', 'Modbus requests by result', ('device', 'slave', 'result'))
+
+# Single request on the bus. The bus thread sends it and waits for the
+# matching answer, which modbus.event() stores in `result`
+class Transaction(object):
+    def __init__(self, maddr, func, req, timeout):
+        self.maddr = maddr
+        self.func = func
+        self.req = req
+        self.timeout = timeout
+        self.result = None
+        self.answered = threading.Event()
+        self.finished = threading.Event()
+
+    def match(self, d):
+        return self.maddr == d[0] and self.func == d[1] & 0x7F
 
 class modbus(object):
     def __init__(self, addr, config=None):
@@ -19,10 +42,24 @@ class modbus(object):
         self.addr = addr
         self.log.log("Modbus protocol for {} created".format(addr))
         self.dev = device.device(addr=addr, threaded=False, onStatus=self.event, onConnect=self.onConnect)
-        self.crc16 = crcmod.mkCrcFun(0x18005, rev=True, initCrc=0xFFFF, xorOut=0x0000)
-        self.wait_addr = None
-        self.wait_func = None
-        self.wait_res = None
+        self.crc16 = crc.crc16
+        self.current = None
+        self.q = queue.Queue()
+        self.slaves = health.Health(name=addr)
+        self.thread = threading.Thread(target=self.loop, args=())
+        self.thread.daemon = True
+        self.watch = watcher.register('modbus-{}'.format(addr), self.thread, timeout=watcher.STALL_TIMEOUT, onDeath=watcher.RESTART, restart=self._restartLoop)
+        self.thread.start()
+
+    def _restartLoop(self):
+        # release the caller of the transaction the dead thread was handling
+        tx, self.current = self.current, None
+        if tx:
+            tx.finished.set()
+        self.thread = threading.Thread(target=self.loop, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
 
     def onConnect(self):
         if self.config: # Change device hardware parameters according to provided
@@ -38,52 +75,90 @@ class modbus(object):
         if not data or len(data)<8: return
         d = bytes().fromhex(data[2:])
         #check CRC
-        crc = self.crc16(d[:-2])
-        if ((d[-1]<<8)|d[-2]) != crc:
-            self.log.log("Packet CRC missmuch. {} != {}".format((d[-1]<<8)|d[-2], crc), "RED")
+        if not crc.check(d):
+            self.log.error("Packet CRC missmuch. {} != {}", (d[-1]<<8)|d[-2], self.crc16(memoryview(d)[:-2]), sampled=True)
         #self.log.log("Answer from modbus {} func {}".format(d[0], d[1]))
-        if self.wait_addr == d[0] and self.wait_func == d[1]:
-            if self.wait_func == 3:
-                self.wait_res = d[3:-2]
-                return
-            if self.wait_func == 16:
-                return True
-        self.log.log("a: {}/{}, f:{}/{}".format(self.wait_addr, d[0], self.wait_func, d[1]))
+        tx = self.current
+        if tx and tx.match(d):
+            if d[1] & 0x80:
+                self.log.log("Modbus exception {} from {} func {}".format(d[2], d[0], tx.func), "YELLOW")
+            elif tx.func in (3, 4):
+                tx.result = d[3:-2]
+            elif tx.func == 16:
+                tx.result = d[2:6]
+            else:
+                tx.result = d[2:-2]
+            tx.answered.set()
+            return tx.result is not None
+        self.log.log("a: {}/{}, f:{}/{}".format(tx.maddr if tx else None, d[0], tx.func if tx else None, d[1]))
+
+    def loop(self):
+        # serializes requests on the bus: next one is sent after an answer or timeout
+        while True:
+            tx = self.q.get()
+            self.watch.busy()
+            slave = self.slaves.get(tx.maddr)
+            # the circuit may have opened while the request was queued
+            if slave.allow():
+                self.current = tx
+                sent = time.monotonic()
+                self.api.setStatus(self.addr, tx.req)
+                if tx.answered.wait(slave.timeout(tx.timeout)):
+                    rtt = time.monotonic() - sent
+                    slave.success(rtt)
+                    RTT.labels(self.addr, tx.maddr).observe(rtt)
+                    REQUESTS.labels(self.addr, tx.maddr, 'ok' if tx.result is not None else 'exception').inc()
+                else:
+                    slave.failure()
+                    REQUESTS.labels(self.addr, tx.maddr, 'timeout').inc()
+                    self.log.log("ERROR: Modbus timeout of {}".format(tx.maddr), "YELLOW")
+            else:
+                REQUESTS.labels(self.addr, tx.maddr, 'rejected').inc()
+            self.current = None
+            tx.finished.set()
+            self.watch.idle()
+
+    def health(self):
+        return self.slaves.stats()
+
+    def transact(self, maddr, func, req, timeout):
+        # do not queue requests for a dead slave behind the others
+        if self.slaves.get(maddr).blocked():
+            REQUESTS.labels(self.addr, maddr, 'rejected').inc()
+            return None
+        c = self.crc16(req)
+        req+= bytes([c&0xff, c>>8])
+        tx = Transaction(maddr, func, req, timeout)
+        self.q.put(tx)
+        tx.finished.wait()
+        return tx.result
 
     def nums(self, data, l):
-        res = [0]*(len(data)//l)
-        for i in range(len(data)):
-            res[i//l]|= data[i]<<((l - i%l - 1)*8)
-        return res
+        if l == 1:
+            return list(data)
+        if l in (2, 4, 8):
+            return regs.decode(data, 'u{}'.format(l*8))
+        return [int.from_bytes(data[i:i+l], 'big') for i in range(0, len(data)//l*l, l)]
 
     def read(self, maddr, addr, func=3, len=1, timeout=0.5, numlen=None):
-        if func==3:
-            req = bytes([maddr, func, addr>>8, addr&0xFF, len>>8, len&0xFF])
-        crc = self.crc16(req)
-        req+= bytes([crc&0xff, crc>>8])
-        self.wait_addr = maddr
-        self.wait_func = func
-        self.wait_res = None
-        self.api.setStatus(self.addr, req)
-        t = time.monotonic()
-        while (t+timeout)>=time.monotonic():
-            if self.wait_res:
-                return self.wait_res if not numlen else self.nums(self.wait_res, numlen)
-        self.log.log("ERROR: Modbus timeout", "YELLOW")
-        return None
+        if func not in (3, 4):
+            self.log.log("Unsupported modbus read function {}".format(func), "RED")
+            return None
+        req = bytes([maddr, func, addr>>8, addr&0xFF, len>>8, len&0xFF])
+        res = self.transact(maddr, func, req, timeout)
+        if res is None:
+            return None
+        return res if not numlen else self.nums(res, numlen)
 
     def write(self, maddr, addr, data, func=16, len=1, timeout=0.4):
-        if func==16:
-            req = bytes([maddr, func, addr>>8, addr&0xFF, len>>8, len&0xFF, len*2])+data
-        crc = self.crc16(req)
-        req+= bytes([crc&0xff, crc>>8])
-        self.wait_addr = maddr
-        self.wait_func = func
-        self.wait_res = None
-        self.api.setStatus(self.addr, req)
-        t = time.monotonic()
-        while (t+timeout)>=time.monotonic():
-            if self.wait_res:
-                return self.wait_res if not numlen else self.nums(self.wait_res, numlen)
-        self.log.log("ERROR: Modbus timeout", "YELLOW")
-        return None
+        if func != 16:
+            self.log.log("Unsupported modbus write function {}".format(func), "RED")
+            return None
+        req = bytes([maddr, func, addr>>8, addr&0xFF, len>>8, len&0xFF, len*2])+data
+        return self.transact(maddr, func, req, timeout)
+
+    def readValues(self, maddr, addr, type='u16', count=1, func=3, wordswap=False, timeout=0.5):
+        res = self.read(maddr, addr, func=func, len=count*regs.size(type), timeout=timeout)
+        if res is None:
+            return None
+        return regs.decode(res, type, wordswap)
@@ -0,0 +1,155 @@
+import threading
+import time
+import heapq
+import yaml
+
+from api import regs
+from api import watcher
+
+MAX_REGS = 125 # registers per function 3/4 request
+MAX_GAP = 8 # unused registers read to join two blocks into one request
+INTERVAL = 5
+
+# Register map example (YAML or JSON):
+#
+# slaves:
+#   - maddr: 1
+#     interval: 5       # default poll interval of this slave, seconds
+#     gap: 8            # optional, 0 for devices that reject reads of unmapped registers
+#     registers:
+#       - {name: voltage, addr: 0, type: f32}
+#       - {name: power, addr: 12, type: i32, wordswap: true, scale: 0.1, interval: 1}
+#       - {name: state, addr: 100, func: 4}
+
+class Register(object):
+    def __init__(self, maddr, cfg, interval):
+        self.maddr = maddr
+        self.addr = int(cfg['addr'])
+        self.name = cfg.get('name', '{}:{}'.format(maddr, self.addr))
+        self.type = cfg.get('type', 'u16')
+        self.size = regs.size(self.type)
+        self.func = int(cfg.get('func', 3))
+        self.wordswap = bool(cfg.get('wordswap', False))
+        self.scale = cfg.get('scale')
+        self.interval = float(cfg.get('interval', interval))
+
+    def decode(self, block, start):
+        off = (self.addr - start) * 2
+        v = regs.decode(block[off:off + self.size*2], self.type, self.wordswap)[0]
+        return v * self.scale if self.scale else v
+
+# Registers read with one request
+class Group(object):
+    def __init__(self, reg):
+        self.maddr = reg.maddr
+        self.func = reg.func
+        self.interval = reg.interval
+        self.start = reg.addr
+        self.end = reg.addr + reg.size
+        self.regs = [reg]
+
+    def join(self, reg, gap):
+        end = max(self.end, reg.addr + reg.size)
+        if reg.addr - self.end > gap or end - self.start > MAX_REGS:
+            return False
+        self.end = end
+        self.regs.append(reg)
+        return True
+
+    def __repr__(self):
+        return 'Group(maddr={}, func={}, start={}, len={}, interval={})'.format(self.maddr, self.func, self.start, self.end - self.start, self.interval)
+
+def merge(registers, gap=MAX_GAP):
+    # joins registers of one slave into the fewest requests
+    groups = []
+    key = lambda r: (r.func, r.interval, r.addr)
+    for reg in sorted(registers, key=key):
+        g = groups[-1] if groups else None
+        if g and g.func == reg.func and g.interval == reg.interval and g.join(reg, gap):
+            continue
+        groups.append(Group(reg))
+    return groups
+
+# Polls register map through api.modbus.modbus and publishes changed values
+# with dev.setStatus({name: value, ...})
+class Poller(object):
+    def __init__(self, mb, dev, config, name=None):
+        self.mb = mb
+        self.dev = dev
+        self.log = mb.log
+        self.values = {}
+        self.groups = []
+        for slave in config.get('slaves', []):
+            maddr = int(slave['maddr'])
+            interval = slave.get('interval', INTERVAL)
+            registers = [Register(maddr, r, interval) for r in slave.get('registers', [])]
+            self.groups += merge(registers, slave.get('gap', MAX_GAP))
+        self.log.log("Modbus poller: {} registers in {} requests".format(sum(len(g.regs) for g in self.groups), len(self.groups)))
+        self.name = name or 'poller-{}'.format(mb.addr)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.watch = None
+        if not self.groups:
+            # nothing to poll: a thread would end at once and count as dead
+            return
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.watch = watcher.register(self.name, self.thread, timeout=watcher.STALL_TIMEOUT, onDeath=watcher.RESTART, restart=self._restart)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        # unwatched first, the ending thread is not restarted
+        if self.watch:
+            watcher.unregister(self.name)
+            self.watch = None
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def _restart(self):
+        # the schedule starts over, values already published are kept
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    @classmethod
+    def load(cls, mb, dev, path, name=None):
+        with open(path, 'r') as f:
+            return cls(mb, dev, yaml.safe_load(f), name)
+
+    def poll(self, g):
+        block = self.mb.read(g.maddr, g.start, func=g.func, len=g.end - g.start)
+        if block is None or len(block) < (g.end - g.start)*2:
+            return
+        block = memoryview(block)
+        changed = {}
+        for r in g.regs:
+            v = r.decode(block, g.start)
+            if self.values.get(r.name) != v:
+                self.values[r.name] = v
+                changed[r.name] = v
+        if changed:
+            self.dev.setStatus(changed)
+
+    def run(self):
+        now = time.monotonic()
+        q = [(now, i) for i in range(len(self.groups))]
+        heapq.heapify(q)
+        while q and not self.stopped.is_set():
+            t, i = q[0]
+            delay = t - time.monotonic()
+            if delay > 0 and self.stopped.wait(delay):
+                break
+            heapq.heappop(q)
+            g = self.groups[i]
+            watch = self.watch
+            if watch:
+                watch.busy()
+            try:
+                self.poll(g)
+            finally:
+                if watch:
+                    watch.idle()
+            # keep the schedule, but never try to catch up missed polls
+            heapq.heappush(q, (max(t + g.interval, time.monotonic()), i))
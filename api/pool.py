@@ -0,0 +1,144 @@
+import threading
+import collections
+import queue
+import traceback
+import functools
+
+from api import log
+from api import watcher
+
+POOL_SIZE = 4
+MAILBOX_SIZE = 10
+BATCH = 16 # items processed per mailbox turn before yielding the worker
+BLOCK_TIMEOUT = 0.1
+
+# Overflow policies
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce' # keep only the latest pending item
+BLOCK = 'block' # wait up to BLOCK_TIMEOUT for room, then drop the new item
+
+_shared = None
+_sharedLock = threading.Lock()
+
+# Ordered per-device queue. With a WorkerPool its items are handled strictly
+# one after another by the pool, different mailboxes run in parallel. Without
+# a pool it is a plain blocking queue for a dedicated thread (see get()).
+class Mailbox(object):
+    def __init__(self, pool=None, handler=None, maxsize=MAILBOX_SIZE, policy=DROP_OLDEST, blockTimeout=BLOCK_TIMEOUT):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, COALESCE, BLOCK):
+            raise ValueError("Unknown overflow policy: {}".format(policy))
+        self.pool = pool
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.blockTimeout = blockTimeout
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.scheduled = False
+        self.dropped = 0
+        self.coalesced = 0
+
+    def qsize(self):
+        return len(self.items)
+
+    def _full(self):
+        return self.maxsize and len(self.items) >= self.maxsize
+
+    # Returns False if the item was dropped. Only BLOCK policy with block=True may wait
+    def put(self, item, block=True):
+        with self.cond:
+            if self.policy == COALESCE and self.items:
+                self.coalesced += len(self.items)
+                self.items.clear()
+            elif self._full():
+                if self.policy == BLOCK and block:
+                    self.cond.wait_for(lambda: not self._full(), self.blockTimeout)
+                if self._full():
+                    self.dropped += 1
+                    if self.policy != DROP_OLDEST:
+                        return False
+                    self.items.popleft()
+            self.items.append(item)
+            if not self.pool:
+                self.cond.notify_all()
+                return True
+            if self.scheduled:
+                return True
+            self.scheduled = True
+        self.pool.schedule(self)
+        return True
+
+    def get(self):
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def run(self):
+        for i in range(BATCH):
+            with self.cond:
+                if not self.items:
+                    self.scheduled = False
+                    return
+                item = self.items.popleft()
+                self.cond.notify_all()
+            try:
+                self.handler(item)
+            except Exception:
+                self.pool.log.log("Error in mailbox handler: {}".format(traceback.format_exc()), 'RED')
+        self.pool.schedule(self)
+
+class WorkerPool(object):
+    def __init__(self, workers=POOL_SIZE, name='pool'):
+        self.log = log.LogThread()
+        self.q = queue.SimpleQueue()
+        self.threads = []
+        self.watches = []
+        self.current = [None] * workers # mailbox each worker is running
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, args=(i,))
+            thread.daemon = True
+            self.watches.append(watcher.register('{}-{}'.format(name, i), thread, timeout=watcher.STALL_TIMEOUT, onDeath=watcher.RESTART, restart=functools.partial(self._restart, i)))
+            self.threads.append(thread)
+            thread.start()
+
+    def _restart(self, i):
+        # the dead worker left its mailbox scheduled: queue it again, or
+        # clear the flag if it has nothing left, so the device goes on
+        mailbox, self.current[i] = self.current[i], None
+        if mailbox:
+            with mailbox.cond:
+                scheduled = mailbox.scheduled = bool(mailbox.items)
+            if scheduled:
+                self.schedule(mailbox)
+        thread = self.threads[i] = threading.Thread(target=self.run, args=(i,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def mailbox(self, handler, maxsize=MAILBOX_SIZE, policy=DROP_OLDEST):
+        return Mailbox(self, handler, maxsize, policy)
+
+    def schedule(self, mailbox):
+        self.q.put(mailbox)
+
+    def run(self, i):
+        watch = self.watches[i]
+        while True:
+            mailbox = self.current[i] = self.q.get()
+            watch.busy()
+            try:
+                mailbox.run()
+                self.current[i] = None
+            finally:
+                watch.idle()
+
+def shared(workers=POOL_SIZE):
+    global _shared
+    with _sharedLock:
+        if not _shared:
+            _shared = WorkerPool(workers)
+    return _shared
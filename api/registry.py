@@ -0,0 +1,62 @@
+import threading
+
+KEYS = ('addr-key', 'addr')
+
+# Registered pnp devices indexed by 'addr-key'/'addr'. Tracks which devices
+# changed since the last commit so only those are sent again; after a
+# reconnect the whole list is resent.
+class DeviceRegistry(object):
+    def __init__(self):
+        self.devs = {k: {} for k in KEYS}
+        self.dirty = {}
+        self.resync = True
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(d) for d in self.devs.values())
+
+    def key(self, devinfo):
+        for k in KEYS:
+            if k in devinfo:
+                return k, devinfo[k]
+        return None
+
+    def get(self, devinfo):
+        key = self.key(devinfo)
+        return self.devs[key[0]].get(key[1]) if key else None
+
+    # Returns True if device is new or its info changed
+    def update(self, devinfo):
+        key = self.key(devinfo)
+        if not key:
+            return False
+        with self.lock:
+            devs = self.devs[key[0]]
+            if devs.get(key[1]) == devinfo:
+                return False
+            # keep a copy: callers tend to pass the same dict again after modifying it
+            devs[key[1]] = dict(devinfo)
+            self.dirty[key] = True
+        return True
+
+    def remove(self, devinfo):
+        key = self.key(devinfo)
+        if key:
+            with self.lock:
+                self.devs[key[0]].pop(key[1], None)
+                self.dirty.pop(key, None)
+
+    # Returns devices to be sent and marks them as committed
+    def take(self):
+        with self.lock:
+            if self.resync:
+                res = [d for k in KEYS for d in self.devs[k].values()]
+            else:
+                res = [self.devs[k][v] for k, v in self.dirty]
+            self.dirty = {}
+            self.resync = False
+        return res
+
+    def invalidate(self):
+        with self.lock:
+            self.resync = True
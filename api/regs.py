@@ -0,0 +1,59 @@
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Bulk decoding of raw Modbus register blocks. Registers are big endian
+# 16 bit words; multi-word values are big word first unless wordswap=True
+# (low word first, e.g. CDAB float layout).
+
+# type: (struct code, words per value)
+TYPES = {
+    'u16': ('H', 1),
+    'i16': ('h', 1),
+    'u32': ('I', 2),
+    'i32': ('i', 2),
+    'u64': ('Q', 4),
+    'i64': ('q', 4),
+    'f32': ('f', 2),
+    'f64': ('d', 4),
+}
+
+def size(type):
+    # number of registers used by one value of `type`
+    return TYPES[type][1]
+
+def swapwords(data, words):
+    # reverse word order inside every group of `words` registers
+    if words == 1:
+        return data
+    res = bytearray(len(data))
+    step = words * 2
+    for i in range(words):
+        j = (words - 1 - i) * 2
+        res[i*2::step] = data[j::step]
+        res[i*2+1::step] = data[j+1::step]
+    return res
+
+def decode(data, type='u16', wordswap=False, asarray=False):
+    # data: register block as bytes/bytearray/memoryview. Returns list of values,
+    # numpy array if asarray=True and numpy is installed
+    code, words = TYPES[type]
+    n = len(data) // (words * 2)
+    data = memoryview(data)[:n * words * 2]
+    if wordswap:
+        data = swapwords(data, words)
+    if asarray and numpy is not None:
+        return numpy.frombuffer(data, dtype='>' + code)
+    return list(struct.unpack('>{}{}'.format(n, code), data))
+
+def encode(values, type='u16', wordswap=False):
+    code, words = TYPES[type]
+    data = struct.pack('>{}{}'.format(len(values), code), *values)
+    return bytes(swapwords(data, words)) if wordswap else data
+
+def words(values):
+    # list of 16 bit register values -> raw register block
+    return struct.pack('>{}H'.format(len(values)), *values)
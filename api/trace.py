@@ -0,0 +1,139 @@
+import os
+import time
+import json
+import threading
+import itertools
+import collections
+import atexit
+
+SIZE = 100000 # spans kept in the ring buffer
+
+# Environment: SH_TRACE=1 enables tracing, SH_TRACE_FILE=path dumps Chrome
+# trace JSON there at exit (open it in chrome://tracing or Perfetto)
+ENABLED = os.environ.get('SH_TRACE', '') not in ('', '0', 'false', 'no')
+FILE = os.environ.get('SH_TRACE_FILE')
+
+# Spans are kept as (name, start ns, end ns, thread id, flow, args) in a ring
+# buffer, timestamps are time.monotonic_ns(). A flow is the id of one
+# received frame: it follows the work through queues and threads so spans of
+# the same request are linked in the trace viewer.
+events = collections.deque(maxlen=SIZE)
+_flows = itertools.count(1)
+_local = threading.local()
+
+def enable(size=SIZE):
+    global ENABLED, events
+    if events.maxlen != size:
+        events = collections.deque(events, maxlen=size)
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def now():
+    return time.monotonic_ns()
+
+def record(name, start, end=None, args=None, flow=None):
+    if ENABLED:
+        events.append((name, start, end or time.monotonic_ns(), threading.get_ident(), flow or current(), args))
+
+def begin():
+    # starts a new flow on the calling thread
+    flow = _local.flow = next(_flows)
+    return flow
+
+def current():
+    return getattr(_local, 'flow', None)
+
+def attach(flow):
+    _local.flow = flow
+
+class Span(object):
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, None, self.args)
+
+class NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NOSPAN = NoSpan()
+
+def span(name, **args):
+    if not ENABLED:
+        return NOSPAN
+    return Span(name, args or None)
+
+# Queue items are wrapped with the flow and the time they were queued at, so
+# the consumer can record the queue wait and continue the flow
+class Carrier(object):
+    __slots__ = ('data', 'flow', 'queued')
+
+    def __init__(self, data, flow, queued):
+        self.data = data
+        self.flow = flow
+        self.queued = queued
+
+def carry(data):
+    if not ENABLED:
+        return data
+    return Carrier(data, current(), time.monotonic_ns())
+
+def resume(item, name='queue wait'):
+    if type(item) is not Carrier:
+        return item
+    attach(item.flow)
+    record(name, item.queued, None, None, item.flow)
+    return item.data
+
+def chrome():
+    pid = os.getpid()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    res = []
+    flows = collections.defaultdict(list)
+    for name, start, end, tid, flow, args in list(events):
+        e = {'name': name, 'cat': 'sh', 'ph': 'X', 'ts': start/1000, 'dur': (end - start)/1000, 'pid': pid, 'tid': tid}
+        if args or flow:
+            e['args'] = dict(args or {}, flow=flow)
+        res.append(e)
+        if flow:
+            flows[flow].append(e)
+    # flow arrows between the spans of one request
+    for flow, spans in flows.items():
+        if len(spans) < 2:
+            continue
+        spans.sort(key=lambda e: e['ts'])
+        for i, e in enumerate(spans):
+            ph = 's' if i == 0 else ('f' if i == len(spans) - 1 else 't')
+            res.append({'name': 'flow', 'cat': 'flow', 'ph': ph, 'id': flow, 'ts': e['ts'], 'pid': pid, 'tid': e['tid'], 'bp': 'e'})
+    for tid in {e['tid'] for e in res}:
+        if tid in names:
+            res.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': names[tid]}})
+    return {'traceEvents': res, 'displayTimeUnit': 'ms'}
+
+def dump(path=None):
+    path = path or FILE
+    with open(path, 'w') as f:
+        json.dump(chrome(), f)
+    return path
+
+def _dumpAtExit():
+    if FILE and events:
+        dump(FILE)
+
+atexit.register(_dumpAtExit)
@@ -3,18 +3,173 @@ from api import log
 import time
 import sys
 import os
+import traceback
 
+STALL_TIMEOUT = 60
+MAX_RESTARTS = 5 # per RESTART_WINDOW, then the process exits
+RESTART_WINDOW = 300
+SWEEP = 5 # seconds between is_alive() checks for threads that ended without an exception
+
+# Policies for a dead or stalled component
+EXIT = 'exit' # log, flush the log and exit the process (systemd restarts it)
+RESTART = 'restart' # call the restart callback of the component
+LOG = 'log' # only log it
+
+# name -> Thread. Threads only listed here exit the process when they die,
+# register() adds heartbeats and restart policies.
 threads = {}
+components = {}
+
+# A watched thread. Components doing units of work call busy() before one
+# and idle() after it: a unit taking longer than `timeout` is a stall.
+# Periodic components (a loop that wakes up at least every few seconds)
+# call beat() instead and stall when no beat came within `timeout`.
+class Component(object):
+    def __init__(self, name, thread=None, timeout=None, periodic=False, onDeath=EXIT, onStall=LOG, restart=None, maxRestarts=MAX_RESTARTS):
+        self.name = name
+        self.thread = thread
+        self.timeout = timeout
+        self.periodic = periodic
+        self.onDeath = onDeath
+        self.onStall = onStall
+        self.restart = restart
+        self.maxRestarts = maxRestarts
+        self.restarts = []
+        self.lastBeat = time.monotonic()
+        self.busySince = None
+        self.progress = 0
+        self.stalled = False
+
+    def beat(self):
+        self.lastBeat = time.monotonic()
+        self.progress += 1
+
+    def busy(self):
+        self.busySince = time.monotonic()
+
+    def idle(self):
+        self.busySince = None
+        self.beat()
+
+    def deadline(self):
+        if not self.timeout:
+            return None
+        if self.periodic:
+            return self.lastBeat + self.timeout
+        since = self.busySince
+        return since + self.timeout if since is not None else None
+
+    def stats(self):
+        return {'alive': bool(self.thread and self.thread.is_alive()), 'stalled': self.stalled,
+                'progress': self.progress, 'idle': time.monotonic() - self.lastBeat, 'restarts': len(self.restarts)}
+
+_cond = threading.Condition()
+_died = []
+
+def register(name, thread, timeout=None, periodic=False, onDeath=EXIT, onStall=LOG, restart=None, maxRestarts=MAX_RESTARTS):
+    c = Component(name, thread, timeout, periodic, onDeath, onStall, restart, maxRestarts)
+    components[name] = c
+    threads[name] = thread
+    with _cond:
+        _cond.notify()
+    return c
+
+# For components allowed to end: it is no longer watched, its thread may exit
+def unregister(name):
+    components.pop(name, None)
+    threads.pop(name, None)
+
+def stats():
+    return {k: c.stats() for k, c in list(components.items())}
+
+# thread deaths by an exception wake the watchdog up at once
+_excepthook = threading.excepthook
+
+def _onThreadException(args):
+    _excepthook(args)
+    with _cond:
+        _died.append(args.thread)
+        _cond.notify()
+
+threading.excepthook = _onThreadException
+
+def _stack(thread):
+    frame = sys._current_frames().get(thread.ident) if thread else None
+    return ''.join(traceback.format_stack(frame)) if frame else ''
+
+def _handle(l, c, reason):
+    policy = c.onDeath if reason == 'dead' else c.onStall
+    l.log("{} thread is {}".format(c.name, reason), 'RED')
+    if reason == 'stalled':
+        l.log("{} stack:\n{}".format(c.name, _stack(c.thread)), 'YELLOW')
+    if policy == LOG:
+        return
+    if policy == RESTART and c.restart:
+        now = time.monotonic()
+        c.restarts = [t for t in c.restarts if now - t < RESTART_WINDOW]
+        if len(c.restarts) < c.maxRestarts:
+            c.restarts.append(now)
+            try:
+                thread = c.restart()
+            except Exception:
+                l.log("{} restart failed: {}".format(c.name, traceback.format_exc()), 'RED')
+            else:
+                if thread:
+                    c.thread = threads[c.name] = thread
+                c.busySince = None
+                c.stalled = False
+                c.beat()
+                l.log("{} thread restarted".format(c.name), 'YELLOW')
+                return
+        else:
+            l.log("{} restarted {} times in {} s".format(c.name, len(c.restarts), RESTART_WINDOW), 'RED')
+    l.log("Exiting", 'RED')
+    log.flush()
+    os._exit(1)
+
+def check(l):
+    now = time.monotonic()
+    for name, c in list(components.items()):
+        # a thread not started yet has no ident
+        if c.thread and c.thread.ident and not c.thread.is_alive():
+            _handle(l, c, 'dead')
+            continue
+        deadline = c.deadline()
+        if deadline is not None and deadline < now:
+            if not c.stalled:
+                c.stalled = True
+                _handle(l, c, 'stalled')
+        elif c.stalled:
+            c.stalled = False
+            l.log("{} thread recovered".format(name), 'GREEN')
+    for k, v in list(threads.items()):
+        if k not in components and not v.is_alive():
+            l.log("{} thread is dead, exiting".format(k), 'RED')
+            log.flush()
+            os._exit(1)
+
+def _nextCheck():
+    # sleep until the earliest possible stall, at most SWEEP seconds
+    now = time.monotonic()
+    wait = SWEEP
+    for c in list(components.values()):
+        deadline = c.deadline()
+        if deadline is not None and not c.stalled:
+            wait = min(wait, deadline - now)
+    return max(wait, 0.01)
 
 def run():
     l = log.LogThread()
     while True:
-        for k,v in threads.items():
-            if not v.is_alive():
-                l.log("{} thread is dead, exiting".format(k), 'RED')
-                time.sleep(1)
-                os._exit(1)
-        time.sleep(1)
+        with _cond:
+            if not _died:
+                _cond.wait(_nextCheck())
+            died = list(_died)
+            _died.clear()
+        # excepthook runs on the dying thread: let it end first
+        for t in died:
+            t.join(1)
+        check(l)
 
 thread = threading.Thread(target=run, args=())
 thread.daemon = True
@@ -0,0 +1,32 @@
+# Micro-benchmark of the API JSON codec on synthetic messages shaped like the
+# she-device-status, statuses and status-set traffic of the API.
+# Run from the repository root: python -m bench.codec
+import json
+import timeit
+
+from api import codec
+
+STATUS = b'-JSON-{"event":"she-device-status","addr-key":"192.168.1.50:502","status":"0x0103040000412ccc16"}'
+STATUSES = b'-JSON-' + json.dumps({
+    "event": "statuses",
+    "devices": [{"addr": "{}:{}".format(300 + i // 16, i % 16), "type": "lamp", "status": {"state": "on" if i % 2 else "off", "level": i % 100, "hex": "0x{:04x}".format(i)}} for i in range(500)],
+}).encode()
+REQUEST = {"request": "status-set", "addr": "302:14", "status": "0x0110000100020400004120ccc16"}
+
+def run(name, fn, number):
+    t = min(timeit.repeat(fn, number=number, repeat=5))
+    print("  {:<32} {:10.2f} us".format(name, t / number * 1e6))
+    return t
+
+def compare(title, std, fast, number):
+    print(title)
+    a = run('json', std, number)
+    if codec.name != 'json':
+        b = run(codec.name, fast, number)
+        print("  speedup x{:.1f}".format(a / b))
+
+if __name__ == '__main__':
+    print("codec: {}".format(codec.name))
+    compare("decode she-device-status", lambda: json.loads(STATUS[6:].decode()), lambda: codec.loads(STATUS, 6), 20000)
+    compare("decode statuses ({} KB)".format(len(STATUSES) // 1024), lambda: json.loads(STATUSES[6:].decode()), lambda: codec.loads(STATUSES, 6), 200)
+    compare("encode status-set", lambda: json.dumps(REQUEST, ensure_ascii=False).encode('utf-8'), lambda: codec.dumps(REQUEST), 20000)
@@ -0,0 +1,37 @@
+# CRC16 benchmark over Modbus RTU frame sizes (8 bytes .. 256 bytes RTU maximum).
+# Run from the repository root: python -m bench.crc
+import os
+import timeit
+
+from api import crc
+
+def crc16_bitwise(frame):
+    # previous modbustcp implementation
+    c = 0xFFFF
+    for b in frame:
+        c ^= b
+        for _ in range(8):
+            lsb = c & 1
+            c >>= 1
+            if lsb:
+                c ^= 0xA001
+    return c
+
+SIZES = (8, 16, 32, 64, 128, 256)
+
+if __name__ == '__main__':
+    print("crc16 backend: {}".format(crc.name))
+    impls = [('bitwise', crc16_bitwise), ('table', crc.crc16_table)]
+    if crc.name != 'table':
+        impls.append((crc.name, crc.crc16))
+    print("{:>6} ".format('bytes') + ''.join("{:>12}".format(n) for n, f in impls) + "  (us per frame)")
+    for size in SIZES:
+        frame = os.urandom(size)
+        assert len(set(f(frame) for n, f in impls)) == 1
+        row = []
+        for n, f in impls:
+            mv = memoryview(frame)
+            number = 20000 if size <= 64 else 5000
+            t = min(timeit.repeat(lambda: f(mv), number=number, repeat=3))
+            row.append(t / number * 1e6)
+        print("{:>6} ".format(size) + ''.join("{:>12.2f}".format(t) for t in row))
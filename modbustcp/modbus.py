@@ -1,7 +1,15 @@
 #!/usr/bin/python3
 import time
 from api import api
+from api import log
 from api import device
+from api import aio
+from api import crc
+from api import regs
+from api import health
+from api import metrics
+from api import trace
+from api import watcher
 
 # Modbus/TCP
 MODBUS_PORT = 502
@@ -213,10 +221,17 @@ def word_list_to_long(val_list, big_endian=True, long_long=False):
     :returns: list of 32 bits int value
     :rtype: list
     """
-    long_list = []
     block_size = 4 if long_long else 2
-    # populate long_list (len is half or quarter of 16 bits val_list) with 32 or 64 bits value
-    for index in range(int(len(val_list) / block_size)):
+    count = len(val_list) // block_size
+    try:
+        # fast path: decode the whole block at once
+        data = regs.words(val_list[:count * block_size])
+        return regs.decode(data, 'u64' if long_long else 'u32', wordswap=not big_endian)
+    except struct.error:
+        pass
+    # values out of the 16 bits range are shifted as they are
+    long_list = []
+    for index in range(count):
         start = block_size * index
         long = 0
         if big_endian:
@@ -230,7 +245,6 @@ def word_list_to_long(val_list, big_endian=True, long_long=False):
                 long += (val_list[start + 3] << 48) + (val_list[start + 2] << 32)
             long += (val_list[start + 1] << 16) + val_list[start]
         long_list.append(long)
-    # return long list
     return long_list
 
 
@@ -314,6 +328,14 @@ def get_list_2comp(val_list, val_size=16):
     :returns: 2's complement result
     :rtype: list
     """
+    code = {16: 'H', 32: 'I', 64: 'Q'}.get(val_size)
+    if code:
+        fmt = '>%d%s' % (len(val_list), code)
+        try:
+            # fast path: reinterpret the whole list of unsigned values as signed
+            return list(struct.unpack(fmt.lower(), struct.pack(fmt, *val_list)))
+        except struct.error:
+            pass
     return [get_2comp(val, val_size) for val in val_list]
 
 
@@ -343,6 +365,24 @@ def decode_ieee(val_int, double=False):
         return struct.unpack("f", struct.pack("I", val_int))[0]
 
 
+def decode_ieee_list(val_list, double=False):
+    """Decode a list of Python int (32 or 64 bits integers) as IEEE single or double precision floats.
+
+    Same as decode_ieee() for every item, in one pass.
+
+    :param val_list: list of 32 or 64 bits integers
+    :type val_list: list
+    :param double: set to decode as 64 bits double precision,
+                   default is 32 bits single (optional)
+    :type double: bool
+    :returns: list of float
+    :rtype: list
+    """
+    code = 'Q' if double else 'I'
+    data = struct.pack('>%d%s' % (len(val_list), code), *val_list)
+    return regs.decode(data, 'f64' if double else 'f32')
+
+
 def encode_ieee(val_float, double=False):
     """Encode Python float to int (32 bits integer) as an IEEE single or double precision format.
 
@@ -369,20 +409,11 @@ def crc16(frame):
     """Compute CRC16.
 
     :param frame: frame
-    :type frame: bytes
+    :type frame: bytes or memoryview
     :returns: CRC16
     :rtype: int
     """
-    crc = 0xFFFF
-    for item in frame:
-        next_byte = item
-        crc ^= next_byte
-        for _ in range(8):
-            lsb = crc & 1
-            crc >>= 1
-            if lsb:
-                crc ^= 0xA001
-    return crc
+    return crc.crc16(frame)
 
 
 def valid_host(host_str):
@@ -421,11 +452,288 @@ def valid_host(host_str):
 
 from dataclasses import dataclass, field
 import random
+import select
 import socket
+import threading
 from socket import AF_UNSPEC, SOCK_STREAM
 import struct
 from typing import Dict
 
+# same metrics as api.modbus, by gateway host:port and unit ID
+RTT = metrics.histogram('modbus_rtt_seconds', 'Modbus request round trip time', ('device', 'slave'))
+REQUESTS = metrics.counter('modbus_requests_total', 'Modbus requests by result', ('device', 'slave', 'result'))
+
+
+class ConnectionPool:
+    """TCP connections to one modbus gateway (host:port) shared by every client of it."""
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, host, port, max_size=4, dns_ttl=300.0, check_idle=5.0):
+        """Constructor.
+
+        :param host: hostname or IPv4/IPv6 address of the gateway
+        :type host: str
+        :param port: TCP port number
+        :type port: int
+        :param max_size: max number of sockets open to the gateway at once
+        :type max_size: int
+        :param dns_ttl: seconds to keep the name resolution result
+        :type dns_ttl: float
+        :param check_idle: connections idle longer than this are checked before use
+        :type check_idle: float
+        """
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.dns_ttl = dns_ttl
+        self.check_idle = check_idle
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []  # (socket, release time)
+        self._addrs = None
+        self._addrs_time = 0.0
+        self.hits = 0  # idle connection reused
+        self.misses = 0  # new connection opened
+        self.reconnects = 0  # broken connection replaced
+        self.in_use = 0
+
+    @classmethod
+    def get(cls, host, port, max_size=4):
+        """Return the pool of host:port, create it on need.
+
+        :returns: shared pool
+        :rtype: ConnectionPool
+        """
+        with cls._pools_lock:
+            key = '%s:%d' % (host, port)
+            if key not in cls._pools:
+                cls._pools[key] = cls(host, port, max_size)
+            return cls._pools[key]
+
+    def _resolve(self):
+        """Return cached getaddrinfo() result."""
+        now = time.monotonic()
+        if not self._addrs or now - self._addrs_time > self.dns_ttl:
+            try:
+                self._addrs = socket.getaddrinfo(self.host, self.port, AF_UNSPEC, SOCK_STREAM)
+            except socket.error:
+                raise ModbusClient._NetworkError(MB_RESOLVE_ERR, 'name resolve error')
+            self._addrs_time = now
+        return self._addrs
+
+    def connect(self, timeout):
+        """Open a new connection with TCP_NODELAY and keepalive set (not counted in the pool).
+
+        :param timeout: socket timeout in seconds
+        :type timeout: float
+        :returns: connected socket
+        :rtype: socket.socket
+        """
+        for af, sock_type, proto, canon_name, sa in self._resolve():
+            try:
+                sock = socket.socket(af, sock_type, proto)
+            except socket.error:
+                continue
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if hasattr(socket, 'TCP_KEEPIDLE'):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+                sock.settimeout(timeout)
+                sock.connect(sa)
+            except socket.error:
+                sock.close()
+                continue
+            return sock
+        # cached address may be stale
+        self._addrs = None
+        raise ModbusClient._NetworkError(MB_CONNECT_ERR, 'connection refused')
+
+    @staticmethod
+    def _healthy(sock):
+        """An idle connection is healthy if it is neither closed by peer nor holding unread data."""
+        # a socket with a timeout waits for it even with MSG_DONTWAIT: only peek when readable
+        try:
+            if not select.select([sock], [], [], 0)[0]:
+                return True
+        except (ValueError, OSError):
+            return False
+        # readable: closed by peer, reset, or stale data
+        return False
+
+    def acquire(self, timeout):
+        """Take a connection, wait while max_size of them are in use.
+
+        :param timeout: socket timeout and max wait time in seconds
+        :type timeout: float
+        :returns: connected socket
+        :rtype: socket.socket
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise ModbusClient._NetworkError(MB_TIMEOUT_ERR, 'no free connection to gateway')
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    sock, released = self._idle.pop()
+                if time.monotonic() - released < self.check_idle or self._healthy(sock):
+                    sock.settimeout(timeout)
+                    with self._lock:
+                        self.hits += 1
+                        self.in_use += 1
+                    return sock
+                sock.close()
+                with self._lock:
+                    self.reconnects += 1
+            sock = self.connect(timeout)
+            with self._lock:
+                self.misses += 1
+                self.in_use += 1
+            return sock
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, sock):
+        """Give a connection back, closed sockets are dropped.
+
+        :param sock: socket returned by acquire()
+        :type sock: socket.socket
+        """
+        with self._lock:
+            if sock.fileno() > 0:
+                self._idle.append((sock, time.monotonic()))
+            else:
+                self.reconnects += 1
+            self.in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        """Pool metrics.
+
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'reconnects': self.reconnects,
+                'in_use': self.in_use, 'idle': len(self._idle), 'max_size': self.max_size}
+
+
+class ReadCache:
+    """Read request coalescing (FC 1-4): identical reads in flight share one reply,
+    replies are kept for a short TTL per unit ID, writes drop overlapping entries."""
+
+    READ_FCS = (READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS)
+    # function codes a write may change the result of
+    WRITE_TARGETS = {
+        WRITE_SINGLE_COIL: (READ_COILS, READ_DISCRETE_INPUTS),
+        WRITE_MULTIPLE_COILS: (READ_COILS, READ_DISCRETE_INPUTS),
+        WRITE_SINGLE_REGISTER: (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS),
+        WRITE_MULTIPLE_REGISTERS: (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS),
+        WRITE_READ_MULTIPLE_REGISTERS: (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS),
+    }
+
+    def __init__(self, ttl=0.0):
+        """Constructor.
+
+        :param ttl: reply cache time in seconds, or dict unit ID -> seconds (key None is the default)
+        :type ttl: float or dict
+        """
+        self.ttl = dict(ttl) if isinstance(ttl, dict) else {None: float(ttl)}
+        self._lock = threading.Lock()
+        self._cache = {}  # request -> (expire time, reply)
+        self._inflight = {}  # request -> callbacks waiting for the same reply
+        self._generation = 0
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def ttl_for(self, unit_id):
+        return self.ttl.get(unit_id, self.ttl.get(None, 0.0))
+
+    @staticmethod
+    def is_read(pdu):
+        return len(pdu) >= 6 and pdu[1] in ReadCache.READ_FCS
+
+    @staticmethod
+    def _write_range(pdu):
+        """Return (first address, count) changed by a write PDU."""
+        fc = pdu[1]
+        if fc in (WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER):
+            return struct.unpack('>H', pdu[2:4])[0], 1
+        if fc == WRITE_READ_MULTIPLE_REGISTERS:
+            return struct.unpack('>HH', pdu[6:10])
+        return struct.unpack('>HH', pdu[2:6])
+
+    def get(self, pdu):
+        """Return cached reply of a read PDU or None."""
+        with self._lock:
+            entry = self._cache.get(bytes(pdu))
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+        return None
+
+    def join(self, pdu, callback):
+        """Register callback for a read PDU.
+
+        :returns: generation to pass to complete() if the caller has to send the request,
+                  None if the same request is already in flight
+        :rtype: int or None
+        """
+        key = bytes(pdu)
+        with self._lock:
+            waiters = self._inflight.get(key)
+            if waiters is not None:
+                waiters.append(callback)
+                self.shared += 1
+                return None
+            self._inflight[key] = [callback]
+            self.misses += 1
+            return self._generation
+
+    def complete(self, pdu, rx_pdu, generation):
+        """Store the reply of a read PDU.
+
+        :returns: callbacks waiting for it
+        :rtype: list
+        """
+        key = bytes(pdu)
+        ttl = self.ttl_for(pdu[0])
+        with self._lock:
+            waiters = self._inflight.pop(key, [])
+            # a write issued meanwhile may have changed the value: don't cache it
+            if rx_pdu and rx_pdu[1] < 0x80 and ttl > 0 and generation == self._generation:
+                self._cache[key] = (time.monotonic() + ttl, rx_pdu)
+        return waiters
+
+    def invalidate(self, pdu):
+        """Drop cached reads overlapping the address range of a write PDU."""
+        targets = self.WRITE_TARGETS.get(pdu[1]) if len(pdu) >= 6 else None
+        if not targets:
+            return
+        try:
+            start, count = self._write_range(pdu)
+        except struct.error:
+            start, count = 0, 0x10000
+        with self._lock:
+            self._generation += 1
+            for key in list(self._cache):
+                if key[0] != pdu[0] or key[1] not in targets:
+                    continue
+                r_start, r_count = struct.unpack('>HH', key[2:6])
+                if r_start < start + count and start < r_start + r_count:
+                    del self._cache[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'shared': self.shared, 'misses': self.misses,
+                'invalidations': self.invalidations, 'size': len(self._cache)}
+
 
 class ModbusClient:
     """Modbus TCP client."""
@@ -442,7 +750,18 @@ class ModbusClient:
         def __init__(self, code):
             self.code = code
 
-    def __init__(self, addrkey, timeout=3, debug=False, auto_open=True, auto_close=False):
+    _MBAP = struct.Struct('>HHH')
+
+    @dataclass
+    class _Pending:
+        callback: object
+        deadline: float
+        slave: object = None
+        sent: float = 0.0
+        unit_id: int = 0
+        flow: int = None
+
+    def __init__(self, addrkey, timeout=3, debug=False, auto_open=True, auto_close=False, pipeline=0, pool_size=0, cache_ttl=0.0):
         """Constructor.
 
         :param host: hostname or IPv4/IPv6 address server address
@@ -459,6 +778,12 @@ class ModbusClient:
         :type auto_open: bool
         :param auto_close: auto TCP close)
         :type auto_close: bool
+        :param pipeline: max number of requests in flight (pipelined mode if > 1)
+        :type pipeline: int
+        :param pool_size: share connections through a ConnectionPool of this size per host:port (0 = off)
+        :type pool_size: int
+        :param cache_ttl: read reply cache time in seconds, or dict unit ID -> seconds
+        :type cache_ttl: float or dict
         :return: Object ModbusClient
         :rtype: ModbusClient
         """
@@ -472,9 +797,23 @@ class ModbusClient:
         self._auto_open = None
         self._auto_close = None
         self._sock = socket.socket()
+        # receive buffers (MBAP + max PDU): one for requests, one for the pipelined receive thread
+        self._rx_buf = bytearray(6 + 256)
+        self._rx_pipe_buf = bytearray(6 + 256)
+        self._pool = None
+        self._addrkey = addrkey
+        self._cache = ReadCache(cache_ttl)
+        # per unit ID: adaptive reply timeout and circuit breaker
+        self._health = health.Health(name=addrkey)
         self._transaction_id = 0  # MBAP transaction ID
         self._last_error = MB_NO_ERR  # last error code
         self._last_except = EXP_NONE  # last except code
+        # pipelined mode: transaction ID -> _Pending
+        self._pending: Dict[int, ModbusClient._Pending] = {}
+        self._pending_lock = threading.Lock()
+        self._tx_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pipeline) if pipeline > 1 else None
+        self._rx_wakeup = threading.Event()
         # public
         # constructor arguments: validate them with property setters
         self.host = addrkey.split(':')[0]
@@ -483,9 +822,16 @@ class ModbusClient:
         self.debug = debug
         self.auto_open = auto_open
         self.auto_close = auto_close
+        if pool_size > 0:
+            self._pool = ConnectionPool.get(self.host, self.port, pool_size)
+            # connections are borrowed per request: a closed socket stands in between them
+            self._sock.close()
+            self._no_sock = self._sock
         self.dev = device.device(addrkey=addrkey, create={"type":"com-port", "name":"ModBUS " + addrkey.split(':')[0]}, threaded=True)
         self.log = self.dev.log
         self.dev.onStatusCallBack(self.onStatus)
+        if self._slots:
+            watcher.register('rx-{}'.format(addrkey), self._start_rx(), onDeath=watcher.RESTART, restart=self._start_rx)
 
     def __repr__(self):
         r_str = 'ModbusClient(host=\'%s\', port=%d, unit_id=%d, timeout=%.2f, debug=%s, auto_open=%s, auto_close=%s)'
@@ -641,26 +987,92 @@ class ModbusClient:
 
     @property
     def is_open(self):
-        """Get current status of the TCP connection (True = open)."""
+        """Get current status of the TCP connection (True = open).
+
+        A pooled client only holds a connection during a request.
+        """
         return self._sock.fileno() > 0
 
+    def health(self):
+        """Health state of every unit ID seen (RTT, circuit state, counters)."""
+        return self._health.stats()
+
+    @property
+    def pipelined(self):
+        """True if several requests may be in flight on the connection."""
+        return self._slots is not None
+
     def onStatus(self, data):
-        self.log.log("MB: Got status: {}".format(data))
+        self.log.info("MB: Got status: {}", data, sampled=True)
         if len(data)<4:
             self.log.log("Incorrect request. too short", "RED")
             return
         if data[-2:] == b'\xcc\x16':
             data = data[:-2]
+        if self.pipelined:
+            self._submit_cached(data, self._on_reply)
+            return
         try:
-            ret = self._req_pdu(data)
-            self.log.log("Returned: {}".format(ret))
+            ret = self._req_cached(data)
+            self.log.info("Returned: {}", ret, sampled=True)
             self.dev.setStatus(ret+b'\xcc\x16')
+        except ModbusClient._ModbusExcept as err:
+            # exception reply, or dead unit with open circuit: answer with an exception PDU
+            self.log.log("Modbus exception {} from {}".format(err.code, data[0]), "YELLOW")
+            self.dev.setStatus(bytes([data[0], data[1] | 0x80, err.code])+b'\xcc\x16')
         except Exception as err:
             self.log.log("Exception: {}".format(err), "RED")
             self.log.log("Closing connection", "YELLOW")
             if self.is_open:
                 self.close()
 
+    def _on_reply(self, rx_pdu, error):
+        if error:
+            self.log.log("Exception: {}".format(getattr(error, 'message', error)), "RED")
+            return
+        self.log.info("Returned: {}", rx_pdu, sampled=True)
+        self.dev.setStatus(rx_pdu+b'\xcc\x16')
+
+    def _req_cached(self, tx_pdu):
+        """Request processing through the read cache."""
+        if not ReadCache.is_read(tx_pdu):
+            self._cache.invalidate(tx_pdu)
+            return self._req_pdu(tx_pdu)
+        rx_pdu = self._cache.get(tx_pdu)
+        if rx_pdu:
+            return rx_pdu
+        generation = self._cache.join(tx_pdu, None)
+        rx_pdu = None
+        try:
+            rx_pdu = self._req_pdu(tx_pdu)
+        finally:
+            self._cache.complete(tx_pdu, rx_pdu, generation)
+        return rx_pdu
+
+    def _submit_cached(self, tx_pdu, callback):
+        """Pipelined request through the read cache: identical reads in flight share one reply.
+
+        Unit health counts transactions, so waiters sharing a timed out read
+        make one failure: the circuit opens after the same number of
+        timeouts on the wire however many callers wait for them.
+        """
+        if not ReadCache.is_read(tx_pdu):
+            self._cache.invalidate(tx_pdu)
+            self.submit(tx_pdu, callback)
+            return
+        rx_pdu = self._cache.get(tx_pdu)
+        if rx_pdu:
+            callback(rx_pdu, None)
+            return
+        generation = self._cache.join(tx_pdu, callback)
+        if generation is None:
+            return
+
+        def on_reply(rx_pdu, error):
+            for cb in self._cache.complete(tx_pdu, rx_pdu, generation):
+                cb(rx_pdu, error)
+        self.submit(tx_pdu, on_reply)
+
     def open(self):
         """Connect to modbus server (open TCP connection).
 
@@ -679,6 +1091,15 @@ class ModbusClient:
         # open an already open socket -> reset it
         if self.is_open:
             self.close()
+        # pooled clients share name resolution and socket options. Pipelined ones keep
+        # a long-lived connection of their own, the others borrow one per request:
+        # outside of a request only check that the pool can get one
+        if self._pool:
+            if self._sock is self._no_sock and not self.pipelined:
+                self._pool.release(self._pool.acquire(self.timeout))
+            else:
+                self._sock = self._pool.connect(self.timeout)
+            return
         # init socket and connect
         # list available sockets on the target host/port
         # AF_xxx : AF_INET -> IPv4, AF_INET6 -> IPv6,
@@ -702,8 +1123,15 @@ class ModbusClient:
             raise ModbusClient._NetworkError(MB_CONNECT_ERR, 'connection refused')
 
     def close(self):
-        """Close current TCP connection."""
-        self._sock.close()
+        """Close current TCP connection.
+
+        A pooled client closes the connection of a request in progress, the
+        pool drops it; idle pool connections stay open for other clients.
+        """
+        if self._sock is not getattr(self, '_no_sock', None):
+            self._sock.close()
+        if getattr(self, '_pending', None):
+            self._fail_pending(ModbusClient._NetworkError(MB_SOCK_CLOSE_ERR, 'socket is closed'))
 
     def custom_request(self, pdu):
         """Send a custom modbus request.
@@ -721,18 +1149,26 @@ class ModbusClient:
             self._req_except_handler(e)
             return None
 
-    def _send(self, frame):
+    def _send(self, frame, pdu=None):
         """Send frame over current socket.
 
-        :param frame: modbus frame to send (MBAP + PDU)
+        :param frame: modbus frame to send (MBAP + PDU), or MBAP only if pdu is set
         :type frame: bytes
+        :param pdu: PDU sent in the same call after frame, without concatenation (optional)
+        :type pdu: bytes
         """
         # check socket
         if not self.is_open:
             raise ModbusClient._NetworkError(MB_SOCK_CLOSE_ERR, 'try to send on a close socket')
         # send
         try:
-            self._sock.send(frame)
+            if pdu is None:
+                self._sock.sendall(frame)
+            else:
+                sent = self._sock.sendmsg([frame, pdu])
+                if sent < len(frame) + len(pdu):
+                    # rare partial send of a tiny frame: finish the rest
+                    self._sock.sendall((bytes(frame) + bytes(pdu))[sent:])
         except socket.timeout:
             self._sock.close()
             raise ModbusClient._NetworkError(MB_TIMEOUT_ERR, 'timeout error')
@@ -749,12 +1185,13 @@ class ModbusClient:
         # for auto_open mode, check TCP and open on need
         if self.auto_open and not self.is_open:
             self._open()
-        # add MBAP header to PDU
-        tx_frame = self._add_mbap(pdu)
+        # build MBAP header, it's sent along with the PDU buffer
+        mbap = self._mbap(pdu)
         # send frame with error check
-        self._send(tx_frame)
+        self._send(mbap, pdu)
         # debug
-        self._debug_dump('Tx', tx_frame)
+        if self.debug:
+            self._debug_dump('Tx', mbap + pdu)
 
     def _recv(self, size):
         """Receive data over current socket.
@@ -777,6 +1214,28 @@ class ModbusClient:
             raise ModbusClient._NetworkError(MB_RECV_ERR, 'recv error')
         return r_buffer
 
+    def _recv_into(self, view):
+        """Receive data over current socket until view is full (avoid TCP frag).
+
+        :param view: writable buffer to fill
+        :type view: memoryview
+        """
+        size = len(view)
+        pos = 0
+        while pos < size:
+            try:
+                n = self._sock.recv_into(view[pos:])
+            except socket.timeout:
+                self._sock.close()
+                raise ModbusClient._NetworkError(MB_TIMEOUT_ERR, 'timeout error')
+            except socket.error:
+                n = 0
+            # handle recv error
+            if not n:
+                self._sock.close()
+                raise ModbusClient._NetworkError(MB_RECV_ERR, 'recv error')
+            pos += n
+
     def _recv_all(self, size):
         """Receive data over current socket, loop until all bytes is received (avoid TCP frag).
 
@@ -785,10 +1244,31 @@ class ModbusClient:
         :returns: receive data or None if error
         :rtype: bytes
         """
-        r_buffer = b''
-        while len(r_buffer) < size:
-            r_buffer += self._recv(size - len(r_buffer))
-        return r_buffer
+        r_buffer = bytearray(size)
+        self._recv_into(memoryview(r_buffer))
+        return bytes(r_buffer)
+
+    def _recv_mbap_frame(self, buf):
+        """Receive MBAP and PDU into buf.
+
+        :param buf: receive buffer, at least 6 + 256 bytes
+        :type buf: bytearray
+        :returns: transaction ID, protocol ID, PDU view
+        :rtype: tuple
+        """
+        view = memoryview(buf)
+        # receive 6 bytes header (MBAP)
+        self._recv_into(view[:6])
+        (f_transaction_id, f_protocol_id, f_length) = self._MBAP.unpack_from(buf)
+        if f_length >= 256:
+            self.close()
+            self._debug_dump('Rx', view[:6])
+            raise ModbusClient._NetworkError(MB_RECV_ERR, 'MBAP checking error')
+        # recv PDU
+        self._recv_into(view[6:6 + f_length])
+        # dump frame
+        self._debug_dump('Rx', view[:6 + f_length])
+        return f_transaction_id, f_protocol_id, view[6:6 + f_length]
 
     def _recv_pdu(self, min_len=2):
         """Receive the modbus PDU (Protocol Data Unit).
@@ -798,27 +1278,18 @@ class ModbusClient:
         :returns: modbus frame PDU or None if error
         :rtype: bytes or None
         """
-        # receive 6 bytes header (MBAP)
-        rx_mbap = self._recv_all(6)
-        # decode MBAP
-        (f_transaction_id, f_protocol_id, f_length) = struct.unpack('>HHH', rx_mbap)
+        (f_transaction_id, f_protocol_id, rx_pdu) = self._recv_mbap_frame(self._rx_buf)
         # check MBAP fields
         f_transaction_err = f_transaction_id != self._transaction_id
         f_protocol_err = f_protocol_id != 0
-        f_length_err = f_length >= 256
         #f_unit_id_err = f_unit_id != self.unit_id
         # checking error status of fields
-        if f_transaction_err or f_protocol_err or f_length_err: # or f_unit_id_err:
+        if f_transaction_err or f_protocol_err: # or f_unit_id_err:
             self.close()
-            self._debug_dump('Rx', rx_mbap)
             raise ModbusClient._NetworkError(MB_RECV_ERR, 'MBAP checking error')
-        # recv PDU
-        rx_pdu = self._recv_all(f_length)
-        # for auto_close mode, close socket after each request
-        if self.auto_close:
+        # for auto_close mode, close socket after each request (pooled sockets are released instead)
+        if self.auto_close and not self._pool:
             self.close()
-        # dump frame
-        self._debug_dump('Rx', rx_mbap + rx_pdu)
         # body decode
         # check PDU length for global minimal frame (an except frame: func code + exp code)
         if len(rx_pdu) < 2:
@@ -832,25 +1303,35 @@ class ModbusClient:
         # check PDU length for specific request set in min_len (keep this after except checking)
         if len(rx_pdu) < min_len:
             raise ModbusClient._NetworkError(MB_RECV_ERR, 'PDU length is too short for current request')
-        # if no error, return PDU
-        return rx_pdu
+        # if no error, return PDU (the only copy of received data)
+        return bytes(rx_pdu)
 
-    def _add_mbap(self, pdu):
+    def _add_mbap(self, pdu, transaction_id=None):
         """Return full modbus frame with MBAP (modbus application protocol header) append to PDU.
 
         :param pdu: modbus PDU (protocol data unit)
         :type pdu: bytes
+        :param transaction_id: MBAP transaction ID, random if not set (optional)
+        :type transaction_id: int
         :returns: full modbus frame
         :rtype: bytes
         """
-        # build MBAP
-        self._transaction_id = random.randint(0, 65535)
-        protocol_id = 0
-        length = len(pdu)
-        mbap = struct.pack('>HHH', self._transaction_id, protocol_id, length)
-        self.unit_id = pdu[0]
         # full modbus/TCP frame = [MBAP]PDU
-        return mbap + pdu
+        return self._mbap(pdu, transaction_id) + pdu
+
+    def _mbap(self, pdu, transaction_id=None):
+        """Return MBAP (modbus application protocol header) of PDU.
+
+        :param pdu: modbus PDU (protocol data unit)
+        :type pdu: bytes
+        :param transaction_id: MBAP transaction ID, random if not set (optional)
+        :type transaction_id: int
+        :returns: MBAP header
+        :rtype: bytes
+        """
+        self._transaction_id = random.randint(0, 65535) if transaction_id is None else transaction_id
+        self.unit_id = pdu[0]
+        return self._MBAP.pack(self._transaction_id, 0, len(pdu))
 
     def _req_pdu(self, tx_pdu, rx_min_len=2):
         """Request processing (send and recv PDU).
@@ -864,10 +1345,178 @@ class ModbusClient:
         """
         # init request engine
         self._req_init()
-        # send PDU
-        self._send_pdu(tx_pdu)
-        # return receive PDU
-        return self._recv_pdu(min_len=rx_min_len)
+        # fail fast while the unit does not answer
+        slave = self._health.get(tx_pdu[0])
+        if not slave.allow():
+            REQUESTS.labels(self._addrkey, tx_pdu[0], 'rejected').inc()
+            raise ModbusClient._ModbusExcept(EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        timeout = slave.timeout(self.timeout)
+        sent = time.monotonic()
+        try:
+            with trace.span('modbus.request', unit=tx_pdu[0]):
+                if self._pool:
+                    rx_pdu = self._req_pooled(tx_pdu, rx_min_len, timeout)
+                else:
+                    # send PDU
+                    self._send_pdu(tx_pdu)
+                    # receive PDU
+                    self._sock.settimeout(timeout)
+                    rx_pdu = self._recv_pdu(min_len=rx_min_len)
+        except ModbusClient._ModbusExcept:
+            self._account(slave, tx_pdu[0], 'exception', time.monotonic() - sent)
+            raise
+        except ModbusClient._NetworkError as e:
+            self._account(slave, tx_pdu[0], 'timeout' if e.code == MB_TIMEOUT_ERR else 'error')
+            raise
+        self._account(slave, tx_pdu[0], 'ok', time.monotonic() - sent)
+        return rx_pdu
+
+    def _account(self, slave, unit_id, result, rtt=None):
+        """Update unit health and metrics with the result of a request."""
+        if rtt is not None:
+            slave.success(rtt)
+            RTT.labels(self._addrkey, unit_id).observe(rtt)
+        elif result == 'timeout':
+            slave.failure()
+        else:
+            # connection errors are not the fault of the unit
+            slave.cancel()
+        REQUESTS.labels(self._addrkey, unit_id, result).inc()
+
+    def _req_pooled(self, tx_pdu, rx_min_len=2, timeout=None):
+        """Request processing on a connection borrowed from the pool."""
+        self._sock = self._pool.acquire(self.timeout)
+        try:
+            self._send_pdu(tx_pdu)
+            self._sock.settimeout(timeout or self.timeout)
+            return self._recv_pdu(min_len=rx_min_len)
+        finally:
+            # on error the socket is already closed and the pool drops it
+            sock = self._sock
+            self._sock = self._no_sock
+            self._pool.release(sock)
+
+    def submit(self, tx_pdu, callback, timeout=None):
+        """Send a request without waiting for its reply (pipelined mode).
+
+        Blocks only while the maximum number of requests is in flight.
+        callback(rx_pdu, error) is called from the receive thread with the reply PDU
+        (exception replies included), or with None and the error on timeout or network failure.
+
+        :param tx_pdu: modbus PDU (protocol data unit) to send
+        :type tx_pdu: bytes
+        :param callback: reply callback
+        :type callback: callable
+        :param timeout: reply timeout in seconds, default is client timeout (optional)
+        :type timeout: float
+        :returns: MBAP transaction ID or None if error
+        :rtype: int or None
+        """
+        if not self.pipelined:
+            raise ValueError('pipelined mode is off')
+        slave = self._health.get(tx_pdu[0])
+        if not slave.allow():
+            REQUESTS.labels(self._addrkey, tx_pdu[0], 'rejected').inc()
+            # reply for the dead unit without taking a slot
+            callback(bytes([tx_pdu[0], tx_pdu[1] | 0x80, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND]), None)
+            return None
+        self._slots.acquire()
+        now = time.monotonic()
+        req = ModbusClient._Pending(callback, now + slave.timeout(timeout or self.timeout), slave, now, tx_pdu[0], trace.current())
+        tid = None
+        try:
+            with self._tx_lock:
+                if self.auto_open and not self.is_open:
+                    self._open()
+                with self._pending_lock:
+                    tid = (self._transaction_id + 1) & 0xFFFF
+                    while tid in self._pending:
+                        tid = (tid + 1) & 0xFFFF
+                    self._pending[tid] = req
+                mbap = self._mbap(tx_pdu, tid)
+                self._send(mbap, tx_pdu)
+            if self.debug:
+                self._debug_dump('Tx', mbap + tx_pdu)
+        except ModbusClient._InternalError as e:
+            self._finish(tid, None, e, req)
+            return None
+        self._rx_wakeup.set()
+        return tid
+
+    def _finish(self, tid, rx_pdu, error, req=None):
+        """Complete a pipelined request and release its slot."""
+        with self._pending_lock:
+            pending = self._pending.pop(tid, None)
+        req = pending or req
+        if not req:
+            self._debug_msg('drop reply with unknown transaction ID %s' % tid)
+            return
+        self._slots.release()
+        if req.slave and rx_pdu is not None:
+            self._account(req.slave, req.unit_id, 'exception' if rx_pdu[1] >= 0x80 else 'ok', time.monotonic() - req.sent)
+        elif req.slave:
+            self._account(req.slave, req.unit_id, 'timeout' if getattr(error, 'code', None) == MB_TIMEOUT_ERR else 'error')
+        if trace.ENABLED and req.sent:
+            # the reply callback continues the flow of the request on this thread
+            trace.attach(req.flow)
+            trace.record('modbus.request', int(req.sent*1e9), None, {'unit': req.unit_id, 'pipelined': True}, req.flow)
+        req.callback(rx_pdu, error)
+
+    def _fail_pending(self, error):
+        """Fail every request in flight."""
+        with self._pending_lock:
+            tids = list(self._pending)
+        for tid in tids:
+            self._finish(tid, None, error)
+
+    def _expire_pending(self):
+        """Fail requests whose reply timeout is over."""
+        now = time.monotonic()
+        with self._pending_lock:
+            tids = [tid for tid, req in self._pending.items() if req.deadline < now]
+        for tid in tids:
+            self._finish(tid, None, ModbusClient._NetworkError(MB_TIMEOUT_ERR, 'timeout error'))
+
+    def _start_rx(self):
+        """Start the receive thread of pipelined mode, requests in flight are kept."""
+        self._rx_thread = threading.Thread(target=self._rx_loop, args=())
+        self._rx_thread.daemon = True
+        self._rx_thread.start()
+        return self._rx_thread
+
+    def _rx_loop(self):
+        """Receive thread of pipelined mode: match replies to requests by transaction ID."""
+        while True:
+            if not self._pending:
+                self._rx_wakeup.wait()
+                self._rx_wakeup.clear()
+                continue
+            sock = self._sock
+            try:
+                readable = select.select([sock], [], [], 0.05)[0]
+            except (ValueError, OSError):
+                # socket closed under us
+                readable = []
+                time.sleep(0.01)
+            if readable and sock is self._sock:
+                try:
+                    tid, rx_pdu = self._recv_frame()
+                    self._finish(tid, rx_pdu, None)
+                except ModbusClient._InternalError as e:
+                    self.close()
+                    self._fail_pending(e)
+            self._expire_pending()
+
+    def _recv_frame(self):
+        """Receive one modbus frame without checking the transaction ID.
+
+        :returns: transaction ID and PDU
+        :rtype: tuple
+        """
+        (f_transaction_id, f_protocol_id, rx_pdu) = self._recv_mbap_frame(self._rx_pipe_buf)
+        if f_protocol_id != 0 or len(rx_pdu) < 2:
+            raise ModbusClient._NetworkError(MB_RECV_ERR, 'MBAP checking error')
+        return f_transaction_id, bytes(rx_pdu)
 
     def _req_init(self):
         """Reset request status flags."""
@@ -927,6 +1576,204 @@ class ModbusClient:
         print(label)
         print(msg)
 
+""" asyncio gateway """
+
+import asyncio
+
+
+class AsyncModbusDevice:
+    """One modbus-devices endpoint of AsyncModbusGateway."""
+
+    def __init__(self, gateway, addrkey, timeout=3, concurrency=1):
+        """Constructor.
+
+        :param gateway: owning gateway
+        :type gateway: AsyncModbusGateway
+        :param addrkey: host:port of the endpoint, also the com-port device addr-key
+        :type addrkey: str
+        :param timeout: connect and reply timeout in seconds
+        :type timeout: float
+        :param concurrency: max requests in flight to the endpoint
+        :type concurrency: int
+        """
+        self.gateway = gateway
+        self.log = gateway.api.log
+        self.addrkey = addrkey
+        self.host = addrkey.split(':')[0]
+        self.port = int(addrkey.split(':')[1])
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._sem = None
+        self._connect_lock = None
+        self._reader = None
+        self._writer = None
+        self._rx_task = None
+        self._pending = {}  # transaction ID -> future
+        self._transaction_id = 0
+        self._health = health.Health(name=addrkey)
+
+    async def _open(self):
+        """Connect on need, replies are read by a separate task."""
+        if not self._sem:
+            self._sem = asyncio.Semaphore(self.concurrency)
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer and not self._writer.is_closing():
+                return
+            try:
+                self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                raise ModbusClient._NetworkError(MB_CONNECT_ERR, 'connection refused')
+            sock = self._writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._rx_task = asyncio.ensure_future(self._rx_loop(self._reader, self._writer))
+
+    async def close(self):
+        """Close the connection, fail requests in flight and wait for the receive task to end."""
+        task, self._rx_task = self._rx_task, None
+        self._drop()
+        if task and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _drop(self):
+        """Close the connection and fail requests in flight."""
+        if self._writer:
+            self._writer.close()
+        self._writer = None
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(ModbusClient._NetworkError(MB_SOCK_CLOSE_ERR, 'socket is closed'))
+
+    async def _rx_loop(self, reader, writer):
+        try:
+            while True:
+                (f_transaction_id, f_protocol_id, f_length) = ModbusClient._MBAP.unpack(await reader.readexactly(6))
+                if f_protocol_id != 0 or f_length >= 256 or f_length < 2:
+                    raise ModbusClient._NetworkError(MB_RECV_ERR, 'MBAP checking error')
+                rx_pdu = await reader.readexactly(f_length)
+                fut = self._pending.pop(f_transaction_id, None)
+                if fut and not fut.done():
+                    fut.set_result(rx_pdu)
+        except (asyncio.IncompleteReadError, OSError, ModbusClient._NetworkError) as err:
+            if writer is self._writer:
+                self.log.log("MB {}: connection closed: {}".format(self.addrkey, getattr(err, 'message', err)), "YELLOW")
+                self._rx_task = None
+                self._drop()
+
+    async def request(self, tx_pdu):
+        """Send a PDU and wait for its reply, at most `concurrency` requests are in flight.
+
+        :param tx_pdu: modbus PDU (protocol data unit) to send
+        :type tx_pdu: bytes
+        :returns: the receive PDU
+        :rtype: bytes
+        """
+        slave = self._health.get(tx_pdu[0])
+        if slave.blocked():
+            REQUESTS.labels(self.addrkey, tx_pdu[0], 'rejected').inc()
+            raise ModbusClient._ModbusExcept(EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        await self._open()
+        async with self._sem:
+            if not slave.allow():
+                REQUESTS.labels(self.addrkey, tx_pdu[0], 'rejected').inc()
+                raise ModbusClient._ModbusExcept(EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+            try:
+                await self._open()
+            except ModbusClient._InternalError:
+                slave.cancel()
+                raise
+            tid = (self._transaction_id + 1) & 0xFFFF
+            while tid in self._pending:
+                tid = (tid + 1) & 0xFFFF
+            self._transaction_id = tid
+            fut = asyncio.get_event_loop().create_future()
+            self._pending[tid] = fut
+            sent = time.monotonic()
+            try:
+                self._writer.writelines([ModbusClient._MBAP.pack(tid, 0, len(tx_pdu)), tx_pdu])
+                await self._writer.drain()
+                rx_pdu = await asyncio.wait_for(fut, slave.timeout(self.timeout))
+                rtt = time.monotonic() - sent
+                slave.success(rtt)
+                RTT.labels(self.addrkey, tx_pdu[0]).observe(rtt)
+                REQUESTS.labels(self.addrkey, tx_pdu[0], 'exception' if rx_pdu[1] >= 0x80 else 'ok').inc()
+                return rx_pdu
+            except asyncio.TimeoutError:
+                slave.failure()
+                REQUESTS.labels(self.addrkey, tx_pdu[0], 'timeout').inc()
+                raise ModbusClient._NetworkError(MB_TIMEOUT_ERR, 'timeout error')
+            except BaseException:
+                slave.cancel()
+                REQUESTS.labels(self.addrkey, tx_pdu[0], 'error').inc()
+                raise
+            finally:
+                self._pending.pop(tid, None)
+
+    def health(self):
+        """Health state of every unit ID seen (RTT, circuit state, counters)."""
+        return self._health.stats()
+
+    def _onCreate(self, data):
+        self.log.log("Device created")
+
+    async def _onStatus(self, data):
+        self.log.info("MB: Got status: {}", data, sampled=True)
+        if len(data)<4:
+            self.log.log("Incorrect request. too short", "RED")
+            return
+        if data[-2:] == b'\xcc\x16':
+            data = data[:-2]
+        try:
+            ret = await self.request(data)
+        except ModbusClient._ModbusExcept as err:
+            self.log.log("Modbus exception {} from {}".format(err.code, data[0]), "YELLOW")
+            ret = bytes([data[0], data[1] | 0x80, err.code])
+        except ModbusClient._InternalError as err:
+            self.log.log("Exception: {}".format(getattr(err, 'message', err)), "RED")
+            # a late reply is dropped by its transaction ID, only a broken connection is closed
+            if getattr(err, 'code', None) != MB_TIMEOUT_ERR:
+                self.log.log("Closing connection", "YELLOW")
+                await self.close()
+            return
+        self.log.info("Returned: {}", ret, sampled=True)
+        await self.gateway.api.request('she-device-status', {"addr-key": self.addrkey, "status": '0x'+(ret+b'\xcc\x16').hex()})
+
+
+class AsyncModbusGateway:
+    """Serves every modbus-devices endpoint from a single asyncio event loop.
+
+    Requests go straight to one connection per endpoint: the connection pool
+    (modbus-pool) and the read cache (modbus-cache-ttl) of ModbusClient are
+    not available in this mode.
+    """
+
+    def __init__(self, addrkeys, name="shsp-modbus-tcp", timeout=3, concurrency=1):
+        """Constructor.
+
+        :param addrkeys: host:port of every endpoint
+        :type addrkeys: list
+        :param name: API application name
+        :type name: str
+        :param timeout: connect and reply timeout in seconds
+        :type timeout: float
+        :param concurrency: max requests in flight per endpoint
+        :type concurrency: int
+        """
+        self.api = aio.AsyncAPIClient(name=name, debug=False)
+        self.devs = {k: AsyncModbusDevice(self, k, timeout, concurrency) for k in addrkeys}
+
+    async def run(self):
+        for addrkey, dev in self.devs.items():
+            self.api.register({"type":"com-port", "name":"ModBUS " + addrkey.split(':')[0], "addr-key": addrkey}, dev)
+        await self.api.run()
+
+
 try:
     from api import report
     report.sendReport("ltplugin-modbus.service")
@@ -936,13 +1783,37 @@ except Exception as e:
 config = open("/home/sh2/plugins/shsp-modbus-tcp-args.txt", 'r').read()
 a = None
 devs = {}
+opts = {}
+addrkeys = []
 for c in config.split("\n"):
     p = c.strip().split(' ')
     if len(p) == 2:
         if p[0]=='modbus-devices':
-            if not a:
-                a = api.APIThread(name="shsp-modbus-tcp", debug=False)
-            devs[p[1]] = ModbusClient(p[1])
+            addrkeys.append(p[1])
+        elif p[0]=='modbus-pipeline':
+            opts['pipeline'] = int(p[1])
+        elif p[0]=='modbus-async':
+            opts['async'] = p[1] not in ('0', 'false', 'no')
+        elif p[0]=='modbus-pool':
+            opts['pool_size'] = int(p[1])
+        elif p[0]=='modbus-cache-ttl':
+            # "0.5" for every unit or "1:0.5,7:2" per unit ID
+            if ':' in p[1]:
+                opts['cache_ttl'] = {int(u): float(t) for u, t in (i.split(':') for i in p[1].split(','))}
+            else:
+                opts['cache_ttl'] = float(p[1])
+
+if opts.pop('async', False):
+    # one event loop for every endpoint, modbus-pipeline sets requests in flight per endpoint
+    for k, name in (('pool_size', 'modbus-pool'), ('cache_ttl', 'modbus-cache-ttl')):
+        if k in opts:
+            log.LogThread().log("{} is not supported with modbus-async, ignored".format(name), 'YELLOW')
+    asyncio.run(AsyncModbusGateway(addrkeys, concurrency=opts.get('pipeline', 1)).run())
+
+for addrkey in addrkeys:
+    if not a:
+        a = api.APIThread(name="shsp-modbus-tcp", debug=False)
+    devs[addrkey] = ModbusClient(addrkey, **opts)
 
 while True:
     time.sleep(1)
@@ -0,0 +1,14 @@
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# plugin scripts start their service after this line
+SERVICE = 'try:\n    from api import report'
+
+# Loads the definitions of a plugin script without starting its service
+def load(path):
+    path = os.path.join(ROOT, path)
+    with open(path) as f:
+        src = f.read()
+    ns = {'__name__': os.path.splitext(os.path.relpath(path, ROOT))[0].replace(os.sep, '.')}
+    exec(compile(src[:src.index(SERVICE)], path, 'exec'), ns)
+    return ns
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+import struct
+import tempfile
+import unittest
+
+from api import aio
+
+# API server on a unix socket: answers every request after `delay` seconds
+# unless its type is in `silent`
+class Server(object):
+    def __init__(self, path, delay=0.0, silent=()):
+        self.path = path
+        self.delay = delay
+        self.silent = silent
+        self.got = []
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle, self.path)
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        try:
+            while True:
+                size = struct.unpack('I', await reader.readexactly(4))[0]
+                req = json.loads((await reader.readexactly(size))[6:])
+                self.got.append(req)
+                if req['request'] not in self.silent:
+                    asyncio.ensure_future(self.answer(writer, req))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def answer(self, writer, req):
+        await asyncio.sleep(self.delay)
+        data = b'-JSON-' + json.dumps({'response': req['request'], 'echo': req.get('n')}).encode()
+        writer.write(struct.pack('I', len(data)) + data)
+
+    def close(self):
+        self.server.close()
+        for w in self.writers:
+            w.close()
+
+class RequestResponse(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'api.sock')
+
+    def run_client(self, test, **kw):
+        async def main():
+            server = Server(self.path, **kw)
+            await server.start()
+            client = aio.AsyncAPIClient(apiPath=self.path)
+            task = asyncio.ensure_future(client.run())
+            for i in range(100):
+                if client.connected:
+                    break
+                await asyncio.sleep(0.01)
+            try:
+                await test(client, server)
+            finally:
+                client.close()
+                server.close()
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        asyncio.run(main())
+
+    def test_responses_in_order(self):
+        async def test(client, server):
+            res = await asyncio.gather(*(client.requestAsync('foo', {'n': i}) for i in range(5)))
+            self.assertEqual([r['echo'] for r in res], list(range(5)))
+            # a plain request of the same type does not take the next response
+            await client.request('foo', {'n': 'plain'})
+            res = await client.requestAsync('foo', {'n': 'mine'})
+            self.assertEqual(res['echo'], 'mine')
+            self.assertEqual(client.pending, {})
+        self.run_client(test, delay=0.01)
+
+    def test_timeout(self):
+        async def test(client, server):
+            with self.assertRaises(TimeoutError):
+                await client.requestAsync('bar', timeout=0.1)
+            self.assertEqual(client.pending, {})
+        self.run_client(test, silent=('bar',))
+
+    def test_disconnect(self):
+        async def test(client, server):
+            fut = asyncio.ensure_future(client.requestAsync('bar'))
+            await asyncio.sleep(0.05)
+            client.reconnect()
+            with self.assertRaises(ConnectionError):
+                await fut
+        self.run_client(test, silent=('bar',))
+
+if __name__ == '__main__':
+    unittest.main()
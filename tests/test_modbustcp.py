@@ -0,0 +1,166 @@
+import socket
+import struct
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from api import log
+from tests import plugin
+
+mb = plugin.load('modbustcp/modbus.py')
+
+class WordListToLong(unittest.TestCase):
+    def test_block(self):
+        self.assertEqual(mb['word_list_to_long']([0x1234, 0x5678, 1, 2]), [0x12345678, 0x10002])
+        self.assertEqual(mb['word_list_to_long']([0x1234, 0x5678], big_endian=False), [0x56781234])
+        self.assertEqual(mb['word_list_to_long']([1, 2, 3, 4], long_long=True), [0x0001000200030004])
+
+    def test_out_of_range_words(self):
+        # values above 0xFFFF are shifted as they are, as before the bulk decoding
+        self.assertEqual(mb['word_list_to_long']([70000, 1]), [4587520001])
+        self.assertEqual(mb['word_list_to_long']([1, 70000], big_endian=False), [4587520001])
+
+# stands in for api.device.device, the client needs no API connection
+class Device(object):
+    def __init__(self, **kw):
+        self.log = log.LogThread()
+
+    def onStatusCallBack(self, cb):
+        pass
+
+    def setStatus(self, data):
+        pass
+
+# modbus gateway: FC3 replies carry the register addresses as values, units
+# in `dead` never answer
+class Gateway(object):
+    def __init__(self, dead=()):
+        self.dead = dead
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.addrkey = '127.0.0.1:{}'.format(self.sock.getsockname()[1])
+        self.requests = 0
+        self.connections = 0
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            self.connections += 1
+            threading.Thread(target=self.read, args=(conn,), daemon=True).start()
+
+    def read(self, conn):
+        while True:
+            head = conn.recv(6, socket.MSG_WAITALL)
+            if len(head) < 6:
+                return
+            pdu = conn.recv(head[5], socket.MSG_WAITALL)
+            self.requests += 1
+            if pdu[0] in self.dead or pdu[1] != 3:
+                continue
+            addr, count = struct.unpack('>HH', pdu[2:6])
+            body = bytes([pdu[0], 3, 2*count]) + struct.pack('>%dH' % count, *range(addr, addr + count))
+            conn.sendall(head[:4] + struct.pack('>H', len(body)) + body)
+
+class Pool(unittest.TestCase):
+    def setUp(self):
+        self.gateway = Gateway()
+        self.host, port = self.gateway.addrkey.split(':')
+        self.port = int(port)
+
+    def test_idle_connection_reused(self):
+        pool = mb['ConnectionPool'](self.host, self.port, max_size=1, check_idle=0.1)
+        sock = pool.acquire(3)
+        pool.release(sock)
+        time.sleep(0.3)
+        # checked before use, without waiting for the socket timeout
+        t = time.monotonic()
+        self.assertIs(pool.acquire(3), sock)
+        self.assertLess(time.monotonic() - t, 0.1)
+        self.assertEqual(pool.stats()['hits'], 1)
+        self.assertEqual(pool.stats()['reconnects'], 0)
+        self.assertEqual(self.gateway.connections, 1)
+
+    def test_closed_idle_connection_replaced(self):
+        pool = mb['ConnectionPool'](self.host, self.port, max_size=1, check_idle=0.1)
+        sock = pool.acquire(3)
+        pool.release(sock)
+        sock.shutdown(socket.SHUT_RDWR)
+        time.sleep(0.2)
+        self.assertIsNot(pool.acquire(3), sock)
+        self.assertEqual(pool.stats()['reconnects'], 1)
+
+class PooledClients(unittest.TestCase):
+    def setUp(self):
+        self.gateway = Gateway()
+        patcher = mock.patch.dict(mb, {'device': types.SimpleNamespace(device=Device)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pipelined_round_trip(self):
+        client = mb['ModbusClient'](self.gateway.addrkey, timeout=1, pipeline=4, pool_size=2)
+        self.addCleanup(client.close)
+        replies = {}
+        done = threading.Event()
+
+        def on_reply(i):
+            def cb(rx_pdu, error):
+                replies[i] = (rx_pdu, error)
+                if len(replies) == 10:
+                    done.set()
+            return cb
+        for i in range(10):
+            client.submit(bytes([1, 3, 0, i, 0, 1]), on_reply(i))
+        self.assertTrue(done.wait(2))
+        self.assertEqual(replies, {i: (bytes([1, 3, 2, 0, i]), None) for i in range(10)})
+
+    def test_serial_round_trip(self):
+        client = mb['ModbusClient'](self.gateway.addrkey, timeout=1, pool_size=2)
+        for i in range(3):
+            self.assertEqual(client.custom_request(bytes([1, 3, 0, i, 0, 1])), bytes([1, 3, 2, 0, i]))
+        self.assertFalse(client.is_open)
+
+class CoalescedReads(unittest.TestCase):
+    def setUp(self):
+        self.gateway = Gateway(dead=(1,))
+        patcher = mock.patch.dict(mb, {'device': types.SimpleNamespace(device=Device)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mb['ModbusClient'](self.gateway.addrkey, timeout=0.2, pipeline=4, cache_ttl=1.0)
+        self.addCleanup(self.client.close)
+
+    def read(self, waiters):
+        errors = []
+        done = threading.Event()
+
+        def on_reply(rx_pdu, error):
+            errors.append((rx_pdu, error))
+            if len(errors) == waiters:
+                done.set()
+        for i in range(waiters):
+            self.client._submit_cached(bytes([1, 3, 0, 0, 0, 1]), on_reply)
+        self.assertTrue(done.wait(2))
+        return errors
+
+    def test_one_failure_per_transaction(self):
+        # waiters of one coalesced read share its timeout: the unit health
+        # counts transactions on the wire, not waiters
+        for i in range(mb['health'].FAILURES):
+            errors = self.read(6)
+            self.assertEqual(len(errors), 6)
+            self.assertTrue(all(e is not None and e.code == mb['MB_TIMEOUT_ERR'] for rx, e in errors))
+            self.assertEqual(self.client.health()[1]['failed'], i + 1)
+        self.assertEqual(self.gateway.requests, mb['health'].FAILURES)
+        self.assertEqual(self.client.health()[1]['state'], mb['health'].OPEN)
+        # the open circuit answers every waiter at once with an exception reply
+        t = time.monotonic()
+        errors = self.read(6)
+        self.assertLess(time.monotonic() - t, 0.1)
+        self.assertTrue(all(rx[1] == 0x83 and rx[2] == mb['EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND'] for rx, e in errors))
+        self.assertEqual(self.gateway.requests, mb['health'].FAILURES)
+
+if __name__ == '__main__':
+    unittest.main()
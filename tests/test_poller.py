@@ -0,0 +1,74 @@
+import threading
+import unittest
+
+from api import log
+from api import poller
+from api import watcher
+
+def registers(*specs, maddr=1, interval=5):
+    return [poller.Register(maddr, cfg, interval) for cfg in specs]
+
+def layout(groups):
+    return [(g.func, g.interval, g.start, g.end - g.start, [r.name for r in g.regs]) for g in groups]
+
+class Merge(unittest.TestCase):
+    def test_gap(self):
+        regs = registers({'name': 'a', 'addr': 0}, {'name': 'b', 'addr': 9, 'type': 'u32'}, {'name': 'c', 'addr': 20})
+        # 8 unused registers between a and b are read, 9 between b and c are not
+        self.assertEqual(layout(poller.merge(regs)), [(3, 5.0, 0, 11, ['a', 'b']), (3, 5.0, 20, 1, ['c'])])
+        self.assertEqual(len(poller.merge(regs, gap=0)), 3)
+        # adjacent registers join without a gap
+        self.assertEqual(len(poller.merge(registers({'addr': 0, 'type': 'f32'}, {'addr': 2}), gap=0)), 1)
+
+    def test_request_size_limit(self):
+        regs = registers(*({'addr': a} for a in range(200)))
+        groups = poller.merge(regs)
+        self.assertEqual([(g.start, g.end - g.start) for g in groups], [(0, poller.MAX_REGS), (poller.MAX_REGS, 200 - poller.MAX_REGS)])
+        # a multi-register value is never split between two requests
+        groups = poller.merge(registers(*({'addr': a*2, 'type': 'u32'} for a in range(63))))
+        self.assertEqual([(g.start, g.end - g.start) for g in groups], [(0, 124), (124, 2)])
+
+    def test_func_and_interval_split(self):
+        regs = registers({'name': 'h', 'addr': 0}, {'name': 'i', 'addr': 1, 'func': 4},
+                         {'name': 'fast', 'addr': 2, 'interval': 1}, {'name': 'h2', 'addr': 3})
+        self.assertEqual(layout(poller.merge(regs)), [(3, 1.0, 2, 1, ['fast']), (3, 5.0, 0, 4, ['h', 'h2']), (4, 5.0, 1, 1, ['i'])])
+
+class Modbus(object):
+    addr = 'test'
+
+    def __init__(self):
+        self.log = log.LogThread()
+        self.reads = 0
+
+    def read(self, maddr, start, func=3, len=1):
+        self.reads += 1
+        return bytes(len*2)
+
+class Device(object):
+    def __init__(self):
+        self.statuses = []
+        self.changed = threading.Event()
+
+    def setStatus(self, data):
+        self.statuses.append(data)
+        self.changed.set()
+
+class PollerLifecycle(unittest.TestCase):
+    def test_empty_map_starts_no_thread(self):
+        p = poller.Poller(Modbus(), None, {'slaves': []}, name='poller-empty')
+        self.assertIsNone(p.thread)
+        self.assertNotIn('poller-empty', watcher.components)
+        p.stop()
+
+    def test_stop(self):
+        dev = Device()
+        p = poller.Poller(Modbus(), dev, {'slaves': [{'maddr': 1, 'registers': [{'name': 'a', 'addr': 0}]}]}, name='poller-stop')
+        self.assertTrue(dev.changed.wait(2))
+        self.assertEqual(dev.statuses, [{'a': 0}])
+        p.stop(2)
+        self.assertFalse(p.thread.is_alive())
+        self.assertNotIn('poller-stop', watcher.components)
+        self.assertNotIn('poller-stop', watcher.threads)
+
+if __name__ == '__main__':
+    unittest.main()
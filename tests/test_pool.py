@@ -0,0 +1,39 @@
+import threading
+import unittest
+
+from api import pool
+
+class Die(BaseException):
+    pass
+
+class WorkerRestart(unittest.TestCase):
+    def test_worker_killed_mid_message(self):
+        workers = pool.WorkerPool(1, name='test-pool')
+        started = threading.Event()
+        resume = threading.Event()
+        done = threading.Event()
+        got = []
+
+        def handler(item):
+            if item == 'die':
+                started.set()
+                resume.wait(2)
+                # not an Exception: the mailbox does not catch it and the worker dies
+                raise Die()
+            got.append(item)
+            if item == 'last':
+                done.set()
+        mailbox = workers.mailbox(handler)
+        mailbox.put('die')
+        self.assertTrue(started.wait(2))
+        # queued behind the message the worker dies on
+        mailbox.put('queued')
+        resume.set()
+        mailbox.put('last')
+        self.assertTrue(done.wait(5), "mailbox stuck after the worker died")
+        self.assertEqual(got, ['queued', 'last'])
+        self.assertEqual(workers.watches[0].stats()['restarts'], 1)
+        self.assertTrue(workers.threads[0].is_alive())
+
+if __name__ == '__main__':
+    unittest.main()